@@ -5,7 +5,11 @@ __date__ ="$Sep 12, 2011"
 
 import sys
 from collections import defaultdict
+from cStringIO import StringIO
+from itertools import islice
+import getopt
 import math
+import multiprocessing
 
 """
 Count n-gram frequencies in a data file and write counts to
@@ -74,6 +78,36 @@ def get_ngrams(sent_iterator, n):
             yield n_gram        
 
 
+def chunk_iterator(corpus_file, chunk_size):
+    """
+    Split the corpus file into chunks of about chunk_size lines. Chunks
+    only end on blank lines, so no sentence is split across two chunks.
+    A second blank line in a row ends the corpus, as in sentence_iterator.
+    """
+    chunk = []
+    last_blank = True
+    for l in corpus_file:
+        blank = not l.strip()
+        chunk.append(l)
+        if blank and last_blank:
+            break
+        if blank and len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+        last_blank = blank
+    if chunk:
+        yield chunk
+
+def count_chunk(args):
+    """
+    Count a single chunk of lines, run in a worker process.
+    """
+    lines, n = args
+    counter = Hmm(n)
+    counter.train(StringIO("".join(lines)))
+    return counter.emission_counts, counter.ngram_counts
+
+
 class Hmm(object):
     """
     Stores counts for n-grams and emissions. 
@@ -109,6 +143,35 @@ class Hmm(object):
             if ngram[-2][0] is None: # this is the first n-gram in a sentence
                 self.ngram_counts[self.n - 2][tuple((self.n - 1) * ["*"])] += 1
 
+    def train_parallel(self, corpus_file, workers, chunk_size=100000):
+        """
+        Count the corpus file in chunks on a pool of worker processes
+        and merge the partial counts. At most 2*workers chunks are in
+        flight at a time.
+        """
+        pool = multiprocessing.Pool(workers)
+        chunks = chunk_iterator(corpus_file, chunk_size)
+        try:
+            while True:
+                tasks = [(lines, self.n) for lines in islice(chunks, 2 * workers)]
+                if not tasks:
+                    break
+                for emission_counts, ngram_counts in pool.imap_unordered(count_chunk, tasks):
+                    self.merge(emission_counts, ngram_counts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def merge(self, emission_counts, ngram_counts):
+        """
+        Add partial counts (as produced by train) to the counts.
+        """
+        for key, count in emission_counts.iteritems():
+            self.emission_counts[key] += count
+        for i, counts in enumerate(ngram_counts):
+            for ngram, count in counts.iteritems():
+                self.ngram_counts[i][ngram] += count
+
     def write_counts(self, output, printngrams=[1,2,3]):
         """
         Writes counts to the output file object.
@@ -150,25 +213,45 @@ class Hmm(object):
 
 def usage():
     print """
-    python count_freqs.py [input_file] > [output_file]
+    python count_freqs.py [-w workers] [-u counts_file] [input_file] > [output_file]
         Read in a gene tagged training input file and produce counts.
+        With -w, the file is counted in chunks on a pool of processes.
+        With -u, the counts of the input file are added to the counts
+        in counts_file and the merged counts are written.
     """
 
 if __name__ == "__main__":
 
-    if len(sys.argv)!=2: # Expect exactly one argument: the training data file
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "w:u:")
+        opts = dict(opts)
+        workers = int(opts.get("-w", 0))
+    except (getopt.GetoptError, ValueError):
+        usage()
+        sys.exit(2)
+    if len(args)!=1: # Expect exactly one argument: the training data file
         usage()
         sys.exit(2)
 
     try:
-        input = file(sys.argv[1],"r")
+        input = file(args[0],"r")
     except IOError:
-        sys.stderr.write("ERROR: Cannot read inputfile %s.\n" % arg)
+        sys.stderr.write("ERROR: Cannot read inputfile %s.\n" % args[0])
         sys.exit(1)
     
     # Initialize a trigram counter
     counter = Hmm(3)
+    if "-u" in opts:
+        # Start from the existing counts, the new data is added to them
+        try:
+            counter.read_counts(file(opts["-u"],"r"))
+        except IOError:
+            sys.stderr.write("ERROR: Cannot read counts file %s.\n" % opts["-u"])
+            sys.exit(1)
     # Collect counts
-    counter.train(input)
+    if workers:
+        counter.train_parallel(input, workers)
+    else:
+        counter.train(input)
     # Write the counts
     counter.write_counts(sys.stdout)
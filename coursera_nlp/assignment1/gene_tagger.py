@@ -1,11 +1,30 @@
 from __future__ import division, print_function
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import argparse
 import math
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import stat
+import sys
+import threading
+import time
+import numpy as np
+# the compiled model container shared by the assignments, in coursera_nlp/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from mapped_arrays import map_arrays, write_arrays
 
 
 MAX_RARE_COUNT = 4
 MIN_LN_PR = -10000.0
+# number of batches read ahead so that sentences can be bucketed by length
+BUCKET_WINDOW = 16
+MODEL_MAGIC = b"HMMMODEL"
+MODEL_VERSION = 1
+# unseen words whose rare-category vector is remembered
+RARE_CACHE_SIZE = 10000
 
 
 def read_counts(fin):
@@ -53,12 +72,84 @@ def read_seqs(fin):
         yield xs
 
 
+def read_batches(seqs, batch_size):
+    batch = []
+    for xs in seqs:
+        batch.append(xs)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_batches_timed(fd, batch_size, max_wait):
+    # like read_batches over read_seqs, but a batch is also cut max_wait seconds after its first sentence
+    buf = b""
+    xs = []
+    batch = []
+    deadline = None
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.time())
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if not ready:
+            yield batch
+            batch = []
+            deadline = None
+            continue
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        lines = (buf + data).split(b"\n")
+        buf = lines.pop()
+        for line in lines:
+            line = line.strip().decode("utf8")
+            if line:
+                xs.append(line)
+                continue
+            if not xs:
+                continue
+            batch.append(xs)
+            xs = []
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+                deadline = None
+            elif deadline is None:
+                deadline = time.time() + max_wait
+    if buf.strip():
+        xs.append(buf.strip().decode("utf8"))
+    if xs:
+        batch.append(xs)
+    if batch:
+        yield batch
+
+
+def write_tags(xs, ys, fout=sys.stdout):
+    assert len(xs) == len(ys)
+    for n, x in enumerate(xs):
+        print(x, ys[n], file=fout)
+    print(file=fout)
+
+
 class TransitionModel(object):
     def __init__(self, unigram, bigram, trigram):
         self.unigram = unigram
         self.bigram = bigram
         self.trigram = trigram
 
+    def update(self, unigram, bigram, trigram):
+        # add the counts of new training data
+        for s, cnt in unigram.items():
+            self.unigram[s] += cnt
+        for s1, s_cnts in bigram.items():
+            for s2, cnt in s_cnts.items():
+                self.bigram[s1][s2] += cnt
+        for s1, s_s_cnts in trigram.items():
+            for s2, s_cnts in s_s_cnts.items():
+                for s3, cnt in s_cnts.items():
+                    self.trigram[s1][s2][s3] += cnt
+
     def get_ln_pr(self, states, state):
         last2_s, last_s = states
         numerator = self.trigram[last2_s][last_s][state]
@@ -69,6 +160,7 @@ class TransitionModel(object):
 
 
 class EmissionModel1(object):
+    CATEGORIES = ["rare_"]
     def __init__(self, y_x_counts):
         self.y_total_counts = {
             y: sum(x_cnts.values()) for y, x_cnts in y_x_counts.items()
@@ -96,6 +188,10 @@ class EmissionModel1(object):
             y_rare_counts[y] = total_cnt
         return common_words, y_rare_counts
 
+    @staticmethod
+    def categorize_rare_words(word):
+        return "rare_"
+
     def get_ln_pr(self, y, x):
         numerator = self.y_x_counts[y][x]
         if x not in self.common_words:
@@ -104,8 +200,33 @@ class EmissionModel1(object):
             return MIN_LN_PR
         return math.log(numerator / self.y_total_counts[y])
 
+    def update(self, y_x_counts):
+        # add the counts of new training data, only the words in it are re-checked for rareness
+        words = set(x for x_cnts in y_x_counts.values() for x in x_cnts)
+        for x in words - self.common_words:
+            for y, x_cnts in self.y_x_counts.items():
+                self.y_rare_counts[y] -= x_cnts.get(x, 0)
+        for y, x_cnts in y_x_counts.items():
+            for x, cnt in x_cnts.items():
+                self.y_x_counts[y][x] += cnt
+            self.y_total_counts[y] = self.y_total_counts.get(y, 0) + sum(x_cnts.values())
+        for x in words:
+            if sum(x_cnts.get(x, 0) for x_cnts in self.y_x_counts.values()) > MAX_RARE_COUNT:
+                self.common_words.add(x)
+                continue
+            self.common_words.discard(x)
+            for y, x_cnts in self.y_x_counts.items():
+                self.y_rare_counts[y] += x_cnts.get(x, 0)
+
+    def get_rare_ln_pr(self, y, category):
+        numerator = self.y_rare_counts[y]
+        if not numerator:
+            return MIN_LN_PR
+        return math.log(numerator / self.y_total_counts[y])
+
 
 class EmissionModel2(object):
+    CATEGORIES = ["numeric_", "all_capitals_", "last_capital_", "rare_"]
     def __init__(self, y_x_counts):
         self.y_total_counts = {
             y: sum(x_cnts.values()) for y, x_cnts in y_x_counts.items()
@@ -155,6 +276,107 @@ class EmissionModel2(object):
             return math.log(numerator / denominator)
         return MIN_LN_PR
 
+    def update(self, y_x_counts):
+        # add the counts of new training data, only the words in it are re-checked for rareness
+        words = set(x for x_cnts in y_x_counts.values() for x in x_cnts)
+        for x in words - self.common_words:
+            category = EmissionModel2.categorize_rare_words(x)
+            for y, x_cnts in self.y_x_counts.items():
+                self.y_rare_counts[y][category] -= x_cnts.get(x, 0)
+        for y, x_cnts in y_x_counts.items():
+            for x, cnt in x_cnts.items():
+                self.y_x_counts[y][x] += cnt
+            self.y_total_counts[y] = self.y_total_counts.get(y, 0) + sum(x_cnts.values())
+            self.y_rare_counts.setdefault(y, defaultdict(int))
+        for x in words:
+            if sum(x_cnts.get(x, 0) for x_cnts in self.y_x_counts.values()) > MAX_RARE_COUNT:
+                self.common_words.add(x)
+                continue
+            self.common_words.discard(x)
+            category = EmissionModel2.categorize_rare_words(x)
+            for y, x_cnts in self.y_x_counts.items():
+                self.y_rare_counts[y][category] += x_cnts.get(x, 0)
+
+    def get_rare_ln_pr(self, y, category):
+        numerator = self.y_rare_counts[y][category]
+        if numerator:
+            return math.log(numerator / self.y_total_counts[y])
+        return MIN_LN_PR
+
+
+class CompiledEmissionModel(object):
+    # emission log-probs as one vector over the states per common word or rare category
+    def __init__(self, states, words, categories, categorize, emission_ln_prs, rare_ln_prs,
+                 cache_size=RARE_CACHE_SIZE):
+        self.states = states
+        self.words = words
+        self.state_ids = {y: n for n, y in enumerate(states)}
+        self.word_ids = {x: n for n, x in enumerate(words)}
+        self.category_ids = {c: n for n, c in enumerate(categories)}
+        self.categorize = categorize
+        self.emission_ln_prs = emission_ln_prs
+        self.rare_ln_prs = rare_ln_prs
+        # LRU of unseen word -> rare-category vector
+        self.rare_cache = OrderedDict()
+        self.cache_size = cache_size
+
+    @staticmethod
+    def from_model(states, emission_model):
+        words = sorted(emission_model.common_words)
+        emission_ln_prs = np.array(
+            [[emission_model.get_ln_pr(y, x) for y in states] for x in words]
+        ).reshape(len(words), len(states))
+        rare_ln_prs = np.array(
+            [[emission_model.get_rare_ln_pr(y, c) for y in states] for c in emission_model.CATEGORIES]
+        )
+        return CompiledEmissionModel(
+            states, words, emission_model.CATEGORIES, emission_model.categorize_rare_words,
+            emission_ln_prs, rare_ln_prs
+        )
+
+    def get_ln_prs(self, x):
+        n = self.word_ids.get(x)
+        if n is not None:
+            return self.emission_ln_prs[n]
+        ln_prs = self.rare_cache.pop(x, None)
+        if ln_prs is None:
+            ln_prs = self.rare_ln_prs[self.category_ids[self.categorize(x)]]
+            if len(self.rare_cache) >= self.cache_size:
+                self.rare_cache.popitem(last=False)
+        self.rare_cache[x] = ln_prs
+        return ln_prs
+
+    def get_ln_pr(self, y, x):
+        return float(self.get_ln_prs(x)[self.state_ids[y]])
+
+
+def compile_model(fout, states, transition_model, emission_model):
+    compiled = CompiledEmissionModel.from_model(states, emission_model)
+    header = {
+        "states": states,
+        "words": compiled.words,
+        "categories": emission_model.CATEGORIES,
+        "emission_model": type(emission_model).__name__,
+    }
+    write_arrays(fout, MODEL_MAGIC, MODEL_VERSION, header, [
+        ("trans_ln_prs", ArrayViterbiDecoder.compile_transitions(states, transition_model)),
+        ("emission_ln_prs", compiled.emission_ln_prs),
+        ("rare_ln_prs", compiled.rare_ln_prs),
+    ])
+
+
+def load_model(fn):
+    header, arrays = map_arrays(fn, MODEL_MAGIC, (MODEL_VERSION,))
+    if header["emission_model"] == EmissionModel2.__name__:
+        categorize = EmissionModel2.categorize_rare_words
+    else:
+        categorize = EmissionModel1.categorize_rare_words
+    emission_model = CompiledEmissionModel(
+        header["states"], header["words"], header["categories"], categorize,
+        arrays["emission_ln_prs"], arrays["rare_ln_prs"]
+    )
+    return header["states"], arrays["trans_ln_prs"], emission_model
+
 
 class NaiveDecoder(object):
     def __init__(self, states, emission_model):
@@ -216,31 +438,337 @@ class ViterbiDecoder(object):
         return list(reversed(results))
 
 
+class ArrayViterbiDecoder(object):
+    # tag ids: 0..S-1 are the states, S is "*" as a history tag and STOP as a target tag
+    STATE_START = "*"
+    STATE_STOP = "STOP"
+    def __init__(self, states, transition_model, emission_model, trans_ln_prs=None,
+                 beam_size=None, beam_threshold=None):
+        self.states = list(states)
+        self.transition_model = transition_model
+        # with a beam only the best (tag, tag) histories are kept at each position
+        self.beam_size = beam_size
+        self.beam_threshold = beam_threshold
+        if not isinstance(emission_model, CompiledEmissionModel):
+            emission_model = CompiledEmissionModel.from_model(self.states, emission_model)
+        self.emission_model = emission_model
+        self.start_id = len(self.states)
+        self.stop_id = len(self.states)
+        if trans_ln_prs is None:
+            trans_ln_prs = ArrayViterbiDecoder.compile_transitions(self.states, transition_model)
+        self.trans_ln_prs = trans_ln_prs
+
+    @staticmethod
+    def compile_transitions(states, transition_model):
+        # trans_ln_prs[u, v, w] = ln q(w | u, v)
+        last_tags = states + [ArrayViterbiDecoder.STATE_START]
+        tags = states + [ArrayViterbiDecoder.STATE_STOP]
+        trans_ln_prs = np.empty((len(last_tags), len(last_tags), len(tags)))
+        for u, last2_s in enumerate(last_tags):
+            for v, last_s in enumerate(last_tags):
+                for w, s in enumerate(tags):
+                    trans_ln_prs[u, v, w] = transition_model.get_ln_pr((last2_s, last_s), s)
+        return trans_ln_prs
+
+    def get_emission_ln_prs(self, x):
+        return self.emission_model.get_ln_prs(x)
+
+    def decode(self, xs):
+        num = len(xs)
+        if not num:
+            return []
+        if self.beam_size or self.beam_threshold is not None:
+            return self.decode_beam(xs)
+        size = len(self.states)
+        # pi_ln_prs[u, v]: best score of a prefix ending with tags (u, v)
+        pi_ln_prs = np.full((size+1, size+1), -np.inf)
+        pi_ln_prs[self.start_id, self.start_id] = 0.0
+        back_traces = np.zeros((num, size+1, size+1), dtype=np.int32)
+        for k, x in enumerate(xs):
+            ln_prs = pi_ln_prs[:, :, None] + self.trans_ln_prs[:, :, :size]
+            ln_prs += self.get_emission_ln_prs(x)
+            next_ln_prs = np.full((size+1, size+1), -np.inf)
+            next_ln_prs[:, :size] = ln_prs.max(axis=0)
+            back_traces[k, :, :size] = ln_prs.argmax(axis=0)
+            pi_ln_prs = next_ln_prs
+        # end of states
+        ln_prs = pi_ln_prs + self.trans_ln_prs[:, :, self.stop_id]
+        u, v = np.unravel_index(np.argmax(ln_prs), ln_prs.shape)
+        return self._back_trace(back_traces, u, v, num)
+
+    def decode_beam(self, xs):
+        num = len(xs)
+        if not num:
+            return []
+        size = len(self.states)
+        width = size + 1
+        # live histories (us[h], vs[h]) and their scores
+        us = np.array([self.start_id])
+        vs = np.array([self.start_id])
+        pi_ln_prs = np.zeros(1)
+        # per position: sorted keys u*width+v of the kept histories and their back-pointers
+        back_traces = []
+        for x in xs:
+            ln_prs = pi_ln_prs[:, None] + self.trans_ln_prs[us, vs, :size]
+            ln_prs += self.get_emission_ln_prs(x)
+            keys = (vs[:, None] * width + np.arange(size)).ravel()
+            ln_prs = ln_prs.ravel()
+            last_us = np.repeat(us, size)
+            # best candidate per new history: sort by key, then by descending score
+            order = np.lexsort((-ln_prs, keys))
+            keys, first = np.unique(keys[order], return_index=True)
+            ln_prs = ln_prs[order][first]
+            last_us = last_us[order][first]
+            kept = self._prune(ln_prs)
+            keys, ln_prs, last_us = keys[kept], ln_prs[kept], last_us[kept]
+            back_traces.append((keys, last_us))
+            us, vs, pi_ln_prs = keys // width, keys % width, ln_prs
+        # end of states
+        best = np.argmax(pi_ln_prs + self.trans_ln_prs[us, vs, self.stop_id])
+        u, v = us[best], vs[best]
+        # back-trace
+        results = [v]
+        for k in range(num-1, 0, -1):
+            keys, last_us = back_traces[k]
+            u, v = last_us[np.searchsorted(keys, u * width + v)], u
+            results.append(v)
+        return [self.states[y] for y in reversed(results)]
+
+    def _prune(self, ln_prs):
+        kept = np.arange(len(ln_prs))
+        if self.beam_threshold is not None:
+            kept = kept[ln_prs >= ln_prs.max() - self.beam_threshold]
+        if self.beam_size and len(kept) > self.beam_size:
+            top = np.argpartition(-ln_prs[kept], self.beam_size - 1)[:self.beam_size]
+            kept = np.sort(kept[top])
+        return kept
+
+    def decode_batch(self, xss, batch_size=64):
+        if self.beam_size or self.beam_threshold is not None:
+            return [self.decode(xs) for xs in xss]
+        # sentences are bucketed by length, so the padding in a batch stays small
+        results = [None] * len(xss)
+        order = sorted(range(len(xss)), key=lambda n: len(xss[n]))
+        for beg in range(0, len(order), batch_size):
+            indices = order[beg:beg+batch_size]
+            for n, ys in zip(indices, self._decode_bucket([xss[n] for n in indices])):
+                results[n] = ys
+        return results
+
+    def _decode_bucket(self, xss):
+        batch = len(xss)
+        lengths = np.array([len(xs) for xs in xss])
+        num = lengths.max()
+        size = len(self.states)
+        pi_ln_prs = np.full((batch, size+1, size+1), -np.inf)
+        pi_ln_prs[:, self.start_id, self.start_id] = 0.0
+        back_traces = np.zeros((num, batch, size+1, size+1), dtype=np.int32)
+        emission_ln_prs = np.zeros((batch, size))
+        for k in range(num):
+            # sentences shorter than k+1 are padding from here on and keep their scores
+            active = lengths > k
+            for b in np.flatnonzero(active):
+                emission_ln_prs[b] = self.get_emission_ln_prs(xss[b][k])
+            ln_prs = pi_ln_prs[:, :, :, None] + self.trans_ln_prs[None, :, :, :size]
+            ln_prs += emission_ln_prs[:, None, None, :]
+            next_ln_prs = np.full((batch, size+1, size+1), -np.inf)
+            next_ln_prs[:, :, :size] = ln_prs.max(axis=1)
+            back_traces[k, :, :, :size] = ln_prs.argmax(axis=1)
+            pi_ln_prs[active] = next_ln_prs[active]
+        # end of states
+        ln_prs = pi_ln_prs + self.trans_ln_prs[None, :, :, self.stop_id]
+        us, vs = np.unravel_index(ln_prs.reshape(batch, -1).argmax(axis=1), ln_prs.shape[1:])
+        return [
+            self._back_trace(back_traces[:, b], us[b], vs[b], lengths[b])
+            for b in range(batch)
+        ]
+
+    def _back_trace(self, back_traces, u, v, num):
+        if not num:
+            return []
+        results = [v]
+        for k in range(num-1, 0, -1):
+            u, v = back_traces[k, u, v], u
+            results.append(v)
+        return [self.states[y] for y in reversed(results)]
+
+
+def compare_decoders(exact_decoder, decoder, seqs, fout=sys.stderr):
+    # how often a pruned decoder differs from exact Viterbi
+    seq_cnt = seq_diff = token_cnt = token_diff = 0
+    exact_time = decode_time = 0.0
+    for xs in seqs:
+        beg = time.time()
+        exact_ys = exact_decoder.decode(xs)
+        mid = time.time()
+        ys = decoder.decode(xs)
+        exact_time += mid - beg
+        decode_time += time.time() - mid
+        diff = sum(y != exact_ys[n] for n, y in enumerate(ys))
+        seq_cnt += 1
+        seq_diff += diff > 0
+        token_cnt += len(xs)
+        token_diff += diff
+    print("sentences", seq_cnt, "differ", seq_diff, "rate", seq_diff / max(seq_cnt, 1), file=fout)
+    print("tokens", token_cnt, "differ", token_diff, "rate", token_diff / max(token_cnt, 1), file=fout)
+    print("exact time", exact_time, "pruned time", decode_time, file=fout)
+
+
+# the decoder being served; the pool always forks, so its workers inherit it as is
+_serve_decoder = None
+
+
+def _decode_batch(xss):
+    if isinstance(_serve_decoder, ArrayViterbiDecoder):
+        return xss, _serve_decoder.decode_batch(xss, len(xss))
+    return xss, [_serve_decoder.decode(xs) for xs in xss]
+
+
+def serve_stream(pool, fd, fout, batch_size, max_wait):
+    batches = read_batches_timed(fd, batch_size, max_wait)
+    if pool:
+        # imap keeps the input order
+        results = pool.imap(_decode_batch, batches)
+    else:
+        results = (_decode_batch(xss) for xss in batches)
+    for xss, yss in results:
+        for xs, ys in zip(xss, yss):
+            write_tags(xs, ys, fout)
+        fout.flush()
+
+
+def _serve_connection(pool, conn, batch_size, max_wait):
+    try:
+        fout = conn.makefile("w")
+        serve_stream(pool, conn.fileno(), fout, batch_size, max_wait)
+        fout.close()
+    finally:
+        conn.close()
+
+
+def _terminate(signum, frame):
+    # a terminated server exits through its cleanup
+    sys.exit(128 + signum)
+
+
+def bind_socket(socket_path):
+    # a socket file left by a killed server is removed, a live one is an error
+    if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except socket.error:
+            os.remove(socket_path)
+        else:
+            raise Exception("a server is listening on %s" % socket_path)
+        finally:
+            probe.close()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    return server
+
+
+def serve(decoder, workers, batch_size, max_wait, socket_path=None):
+    # decode sentences from stdin, or from each connection to a unix socket, until end of input
+    global _serve_decoder
+    _serve_decoder = decoder
+    pool = multiprocessing.get_context("fork").Pool(workers) if workers else None
+    try:
+        if not socket_path:
+            serve_stream(pool, sys.stdin.fileno(), sys.stdout, batch_size, max_wait)
+            return
+        server = bind_socket(socket_path)
+        signal.signal(signal.SIGTERM, _terminate)
+        try:
+            server.listen(8)
+            while True:
+                conn, _ = server.accept()
+                thread = threading.Thread(
+                    target=_serve_connection, args=(pool, conn, batch_size, max_wait)
+                )
+                thread.daemon = True
+                thread.start()
+        finally:
+            server.close()
+            os.remove(socket_path)
+    finally:
+        if pool:
+            pool.terminate()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("fcount")
-    parser.add_argument("fseq")
+    parser.add_argument("fseq", nargs="?")
     parser.add_argument("-t", "--transition", action="store_true")
     parser.add_argument("-c", "--category", action="store_true")
+    parser.add_argument("-a", "--array", action="store_true")
+    parser.add_argument("-b", "--batch", type=int, default=0)
+    parser.add_argument("-o", "--compile", dest="fcompile", default=None)
+    parser.add_argument("-m", "--mmap", action="store_true")
+    parser.add_argument("-u", "--update", dest="fupdate", default=None)
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--socket", default=None)
+    parser.add_argument("-w", "--workers", type=int, default=0)
+    parser.add_argument("--max-wait", type=float, default=10.0, help="micro-batch latency bound in ms")
+    parser.add_argument("--beam", type=int, default=None)
+    parser.add_argument("--beam-threshold", type=float, default=None)
+    parser.add_argument("--beam-report", action="store_true")
     args = parser.parse_args()
+    if not args.transition and (args.beam is not None or args.beam_threshold is not None or args.beam_report):
+        parser.error("--beam, --beam-threshold and --beam-report need -t")
     fn_count = args.fcount
     fn_seq = args.fseq
-    with open(fn_count) as fin:
-        y_x_counts, unigram, bigram, trigram = read_counts(fin)
-    transition_model = TransitionModel(unigram, bigram, trigram)
-    if not args.category:
-        emission_model = EmissionModel1(y_x_counts)
+    if args.mmap:
+        # fcount is a model file written by --compile
+        states, trans_ln_prs, emission_model = load_model(fn_count)
+        transition_model = None
     else:
-        emission_model = EmissionModel2(y_x_counts)
+        with open(fn_count) as fin:
+            y_x_counts, unigram, bigram, trigram = read_counts(fin)
+        states = list(unigram.keys())
+        trans_ln_prs = None
+        transition_model = TransitionModel(unigram, bigram, trigram)
+        if not args.category:
+            emission_model = EmissionModel1(y_x_counts)
+        else:
+            emission_model = EmissionModel2(y_x_counts)
+        if args.fupdate:
+            # counts of new training data only, e.g. count_freqs.py over the new sentences
+            with open(args.fupdate) as fin:
+                new_y_x_counts, new_unigram, new_bigram, new_trigram = read_counts(fin)
+            transition_model.update(new_unigram, new_bigram, new_trigram)
+            emission_model.update(new_y_x_counts)
+            states = list(unigram.keys())
+        if args.fcompile:
+            with open(args.fcompile, "wb") as fout:
+                compile_model(fout, states, transition_model, emission_model)
     if not args.transition:
-        decoder = NaiveDecoder(list(unigram.keys()), emission_model)
+        decoder = NaiveDecoder(states, emission_model)
+    elif args.array or args.mmap or args.beam or args.beam_threshold is not None:
+        decoder = ArrayViterbiDecoder(
+            states, transition_model, emission_model, trans_ln_prs, args.beam, args.beam_threshold
+        )
     else:
-        decoder = ViterbiDecoder(list(unigram.keys()), transition_model, emission_model)
-    with open(fn_seq) as fin:
-        for xs in read_seqs(fin):
-            ys = decoder.decode(xs)
-            assert len(xs) == len(ys)
-            for n, x in enumerate(xs):
-                print(x, ys[n])
-            print()
-        fin.close()
+        decoder = ViterbiDecoder(states, transition_model, emission_model)
+    if args.beam_report:
+        # both decoders share the compiled emissions and transitions
+        exact_decoder = ArrayViterbiDecoder(states, transition_model, emission_model, trans_ln_prs)
+        pruned_decoder = ArrayViterbiDecoder(
+            states, transition_model, exact_decoder.emission_model, exact_decoder.trans_ln_prs,
+            args.beam, args.beam_threshold
+        )
+        with open(fn_seq) as fin:
+            compare_decoders(exact_decoder, pruned_decoder, read_seqs(fin))
+    elif args.serve:
+        serve(decoder, args.workers, max(args.batch, 1), args.max_wait / 1000.0, args.socket)
+    elif fn_seq:
+        with open(fn_seq) as fin:
+            if args.batch and isinstance(decoder, ArrayViterbiDecoder):
+                for xss in read_batches(read_seqs(fin), args.batch * BUCKET_WINDOW):
+                    for xs, ys in zip(xss, decoder.decode_batch(xss, args.batch)):
+                        write_tags(xs, ys)
+            else:
+                for xs in read_seqs(fin):
+                    write_tags(xs, decoder.decode(xs))
+            fin.close()
@@ -4,7 +4,8 @@
 __author__="Alexander Rush <srush@csail.mit.edu>"
 __date__ ="$Sep 12, 2012"
 
-import sys, json
+import sys, json, getopt, multiprocessing
+from itertools import islice
 
 """
 Count rule frequencies in a binarized CFG.
@@ -17,67 +18,114 @@ class Counts:
     self.nonterm = {}
 
   def show(self):
-    for symbol, count in self.nonterm.iteritems():
+    for symbol, count in sorted(self.nonterm.iteritems()):
       print count, "NONTERMINAL", symbol
 
-    for (sym, word), count in self.unary.iteritems():
+    for (sym, word), count in sorted(self.unary.iteritems()):
       print count, "UNARYRULE", sym, word
 
-    for (sym, y1, y2), count in self.binary.iteritems():
+    for (sym, y1, y2), count in sorted(self.binary.iteritems()):
       print count, "BINARYRULE", sym, y1, y2
 
   def count(self, tree): #存储的数据中有［sym＋sym，word］的形式
     """
     Count the frequencies of non-terminals and rules in the tree.
     """
-    #这个if有和没有一样，因为已经将只有一个symbol连接另一个symbol，然后一个word的
-    #改成［‘symbol＋symbol’， ‘string’］的形式了
-    if isinstance(tree, basestring): 
-      #print("basestring, %s\n" % tree)
-      return 
-    #judge the instance(tree) is a string or not
-    #if tree is string, it means the last UNARYRULE
+    # Walk the tree with an explicit stack, so deep trees do not hit the
+    # recursion limit.
+    stack = [tree]
+    while stack:
+      tree = stack.pop()
+      #这个if有和没有一样，因为已经将只有一个symbol连接另一个symbol，然后一个word的
+      #改成［‘symbol＋symbol’， ‘string’］的形式了
+      if isinstance(tree, basestring): 
+        #print("basestring, %s\n" % tree)
+        continue
+      #judge the instance(tree) is a string or not
+      #if tree is string, it means the last UNARYRULE
 
-    # Count the non-terminal symbol. 
-    symbol = tree[0] #start symbol -> S
-    self.nonterm.setdefault(symbol, 0) 
-    #insert the dict item: (symbol, 0), if exists, return the value.
-    self.nonterm[symbol] += 1
-    
-    if len(tree) == 3:
-      # It is a binary rule.
-      y1, y2 = (tree[1][0], tree[2][0])
-      key = (symbol, y1, y2)
-      self.binary.setdefault(key, 0)
-      self.binary[(symbol, y1, y2)] += 1
+      # Count the non-terminal symbol. 
+      symbol = tree[0] #start symbol -> S
+      self.nonterm.setdefault(symbol, 0) 
+      #insert the dict item: (symbol, 0), if exists, return the value.
+      self.nonterm[symbol] += 1
       
-      # Recursively count the children.
-      self.count(tree[1])
-      self.count(tree[2])
-    elif len(tree) == 2:
-      # It is a unary rule.
-      y1 = tree[1]
-      key = (symbol, y1)
-      self.unary.setdefault(key, 0)
-      self.unary[key] += 1
-      #self.count(tree[1])，如果这样，那么35-37行code有用
-      #self.count(tree[2])，因为考虑［‘symbol’，［‘symbol‘，’string'］］的情况
+      if len(tree) == 3:
+        # It is a binary rule.
+        y1, y2 = (tree[1][0], tree[2][0])
+        key = (symbol, y1, y2)
+        self.binary.setdefault(key, 0)
+        self.binary[(symbol, y1, y2)] += 1
+        
+        # Count the children, the left one first.
+        stack.append(tree[2])
+        stack.append(tree[1])
+      elif len(tree) == 2:
+        # It is a unary rule.
+        y1 = tree[1]
+        key = (symbol, y1)
+        self.unary.setdefault(key, 0)
+        self.unary[key] += 1
+        #self.count(tree[1])，如果这样，那么35-37行code有用
+        #self.count(tree[2])，因为考虑［‘symbol’，［‘symbol‘，’string'］］的情况
 
-def main(parse_file):
+  def merge(self, other):
+    """
+    Add the counts of another counter.
+    """
+    for counts, other_counts in ((self.nonterm, other.nonterm),
+                                 (self.unary, other.unary),
+                                 (self.binary, other.binary)):
+      for key, count in other_counts.iteritems():
+        counts[key] = counts.get(key, 0) + count
+
+def count_lines(lines):
+  """
+  Count a chunk of json tree lines, run in a worker process.
+  """
+  counter = Counts()
+  for l in lines:
+    counter.count(json.loads(l))
+  return counter
+
+def main(parse_file, workers=0, chunk_size=10000):
   counter = Counts() 
-  for l in open(parse_file):
-    t = json.loads(l)
-    counter.count(t)
+  f = open(parse_file)
+  if not workers:
+    for l in f:
+      t = json.loads(l)
+      counter.count(t)
+  else:
+    # At most 2*workers chunks of lines are in flight at a time.
+    pool = multiprocessing.Pool(workers)
+    chunks = iter(lambda: list(islice(f, chunk_size)), [])
+    try:
+      while True:
+        tasks = list(islice(chunks, 2 * workers))
+        if not tasks:
+          break
+        for partial in pool.imap_unordered(count_lines, tasks):
+          counter.merge(partial)
+    finally:
+      pool.close()
+      pool.join()
+  f.close()
   counter.show()
 
 def usage():
     sys.stderr.write("""
-    Usage: python count_cfg_freq.py [tree_file]
-        Print the counts of a corpus of trees.\n""")
+    Usage: python count_cfg_freq.py [-w workers] [tree_file]
+        Print the counts of a corpus of trees, sorted.
+        With -w, the trees are counted on a pool of processes.\n""")
 
 if __name__ == "__main__": 
-  if len(sys.argv) != 2:
+  try:
+    opts, args = getopt.getopt(sys.argv[1:], "w:")
+    workers = int(dict(opts).get("-w", 0))
+  except (getopt.GetoptError, ValueError):
+    usage()
+    sys.exit(1)
+  if len(args) != 1:
     usage()
     sys.exit(1)
-  main(sys.argv[1])
-  
+  main(args[0], workers)
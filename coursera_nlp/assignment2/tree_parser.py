@@ -1,13 +1,34 @@
 # coding: utf8
 from __future__ import print_function, division, generators, unicode_literals
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import math
+import os
 import argparse
+import heapq
+import io
 import json
+import multiprocessing
+import re
+import sys
+import time
+import numpy as np
+# the compiled model container shared by the assignments, in coursera_nlp/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from mapped_arrays import map_arrays, write_arrays
 
 
 MAX_RARE_COUNT = 4
-MIN_LN_PR = -1000
+# sentences read ahead and scheduled longest-first by the worker pool
+PARSE_WINDOW = 1024
+# flags of the parses made without a root derivation
+FALLBACK_ROOT = "root"
+FALLBACK_GLUE = "glue"
+# a blank input line has no well-formed tree, as every tree has a word; it is written as
+# a blank output line to keep the lines aligned, and eval_parser.py cannot read it, so
+# inputs to be evaluated should have no blank lines
+FALLBACK_EMPTY = "empty"
+GRAMMAR_MAGIC = b"CFGMODEL"
+GRAMMAR_VERSION = 1
 
 
 def read_counts(fin):
@@ -37,6 +58,75 @@ def read_seqs(fin):
         yield line.split()
 
 
+def read_windows(seqs, window_size):
+    window = []
+    for xs in seqs:
+        window.append(xs)
+        if len(window) >= window_size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def get_glue_tree(tag, subtrees):
+    # right-branching tree joining the subtrees under tag, None when there are none
+    if not subtrees:
+        return None
+    tree = subtrees[-1]
+    for subtree in reversed(subtrees[:-1]):
+        tree = [tag, subtree, tree]
+    return tree
+
+
+def write_glue_tree(fout, tag, subtrees):
+    if not subtrees:
+        return
+    for subtree in subtrees[:-1]:
+        fout.write("[%s, %s, " % (json.dumps(tag), json.dumps(subtree)))
+    fout.write(json.dumps(subtrees[-1]))
+    fout.write("]" * (len(subtrees) - 1))
+
+
+# A chart tree is given by get_children(beg, end, y), which returns the
+# (beg, end, y) nodes of the two children of y spanning [beg, end], inclusively,
+# and by label(y), the nonterminal of y. Both walks use an explicit stack,
+# so long sentences do not hit the recursion limit.
+
+def build_tree(get_children, label, xs, root):
+    tree = []
+    stack = [(root, tree)]
+    while stack:
+        (beg, end, y), node = stack.pop()
+        node.append(label(y))
+        if beg == end:
+            node.append(xs[beg])
+            continue
+        left, right = get_children(beg, end, y)
+        left_node, right_node = [], []
+        node.extend((left_node, right_node))
+        stack.append((right, right_node))
+        stack.append((left, left_node))
+    return tree
+
+
+def write_tree(fout, get_children, label, xs, root):
+    # the same text as json.dumps(build_tree(...)), without building the lists
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        if not isinstance(item, tuple):
+            fout.write(item)
+            continue
+        beg, end, y = item
+        if beg == end:
+            fout.write("[%s, %s]" % (json.dumps(label(y)), json.dumps(xs[beg])))
+            continue
+        left, right = get_children(beg, end, y)
+        fout.write("[%s, " % json.dumps(label(y)))
+        stack.extend(("]", right, ", ", left))
+
+
 class EmissionModel1(object):
     def __init__(self, y_x_counts):
         self.y_total_counts = {
@@ -44,6 +134,15 @@ class EmissionModel1(object):
         }
         self.common_words, self.y_rare_counts = EmissionModel1.replace_rare(y_x_counts)
         self.y_x_counts = y_x_counts
+        # sparse lexical log-probs: only the nonterminals that emit the word, shared by all callers
+        self.rare_ln_prs = {
+            y: math.log(cnt / self.y_total_counts[y]) for y, cnt in self.y_rare_counts.items() if cnt > 0
+        }
+        self.word_ln_prs = {}
+        for y, x_cnts in y_x_counts.items():
+            for x, cnt in x_cnts.items():
+                if cnt > 0 and x in self.common_words:
+                    self.word_ln_prs.setdefault(x, {})[y] = math.log(cnt / self.y_total_counts[y])
 
     @staticmethod
     def replace_rare(y_x_counts):
@@ -65,112 +164,678 @@ class EmissionModel1(object):
             y_rare_counts[y] = total_cnt
         return common_words, y_rare_counts
 
-    def get_ln_pr(self, y, x):
-        numerator = self.y_x_counts[y][x]
-        if x not in self.common_words:
-            numerator = self.y_rare_counts[y]
-        if not numerator:
-            return MIN_LN_PR
-        return math.log(numerator / self.y_total_counts[y])
-
-    def get_state_ln_prs(self, x):
-        if x not in self.common_words:
-            return {
-                y: math.log(cnt/self.y_total_counts[y]) if cnt > 0 else MIN_LN_PR
-                for y, cnt in self.y_rare_counts.items()
-            }
-        return {
-            y: math.log(self.y_x_counts[y][x] / total_cnt) if self.y_x_counts[y][x] > 0 else MIN_LN_PR
-            for y, total_cnt in self.y_total_counts.items()
-        }
+    def get_lexical_ln_prs(self, x):
+        # read-only, the dict is shared
+        return self.word_ln_prs.get(x, self.rare_ln_prs)
 
 
 class BinaryModel(object):
-    def __init__(self, nonterminal_counts, binary_rules):
+    def __init__(self, nonterminal_counts, binary_rules, rule_ln_prs=None):
         self.binary_rules = binary_rules
         self.nontermianl_counts = nonterminal_counts
-        self.rule_ln_prs = {
-            src: {k: math.log(cnt/nonterminal_counts[src]) for k, cnt in dst.items()}
-            for src, dst in binary_rules.items()
-        }
+        if rule_ln_prs is None:
+            rule_ln_prs = {
+                src: {k: math.log(cnt/nonterminal_counts[src]) for k, cnt in dst.items()}
+                for src, dst in binary_rules.items()
+            }
+        self.rule_ln_prs = rule_ln_prs
+        # child index, left_rules[y1][y2] is the list of (high, ln_pr, rank),
+        # rank being the position in get_rules() order
+        self.left_rules = defaultdict(dict)
+        rank = 0
+        for high, low_ln_prs in self.rule_ln_prs.items():
+            for (y1, y2), d_ln_pr in low_ln_prs.items():
+                self.left_rules[y1].setdefault(y2, []).append((high, d_ln_pr, rank))
+                rank += 1
 
-    def get_rule_ln_prs(self, t):
-        return self.rule_ln_prs.get(t, {})
+    def get_left_rules(self, y1):
+        # {y2: [(high, ln_pr, rank)]}, or None when no rule has the left child y1
+        return self.left_rules.get(y1)
 
     def get_rules(self):
         return self.rule_ln_prs
 
+
+class CompiledBinaryModel(object):
+    # binary rules of a compiled grammar, read from the mapped arrays: the rules sorted
+    # by parent for ArrayTreeParser, and the get_left_rules rows for TreeParser, which
+    # are built from child_order on first use of each left child
+    def __init__(self, symbols, nonterminal_counts, rule_parents, rule_lefts, rule_rights,
+                 rule_counts, rule_ln_prs, child_order):
+        self.symbols = symbols
+        self.symbol_ids = {y: n for n, y in enumerate(symbols)}
+        self.nontermianl_counts = {
+            y: cnt for y, cnt in zip(symbols, nonterminal_counts.tolist()) if cnt
+        }
+        self.rule_parents = rule_parents
+        self.rule_lefts = rule_lefts
+        self.rule_rights = rule_rights
+        self.rule_counts = rule_counts
+        self.rule_ln_prs = rule_ln_prs
+        self.child_order = child_order
+        # child_order range of the rules of each left child
+        self.left_offsets = np.searchsorted(rule_lefts[child_order], np.arange(len(symbols) + 1))
+        self.left_rule_cache = {}
+
+    def get_left_rules(self, y1):
+        # {y2: [(high, ln_pr, rank)]}, rank being the position of the rule in the arrays,
+        # or None when no rule has the left child y1
+        if y1 in self.left_rule_cache:
+            return self.left_rule_cache[y1]
+        y2_rules = self.left_rule_cache[y1] = self._read_left_rules(y1) or None
+        return y2_rules
+
+    def _read_left_rules(self, y1):
+        n = self.symbol_ids.get(y1)
+        if n is None:
+            return {}
+        rules = self.child_order[self.left_offsets[n]:self.left_offsets[n+1]]
+        y2_rules = {}
+        for y2, high, d_ln_pr, rank in zip(
+                self.rule_rights[rules].tolist(), self.rule_parents[rules].tolist(),
+                self.rule_ln_prs[rules].tolist(), rules.tolist()):
+            y2_rules.setdefault(self.symbols[y2], []).append((self.symbols[high], d_ln_pr, rank))
+        return y2_rules
+
+    def get_rules(self):
+        # the rule dicts of BinaryModel, in the order of the arrays
+        rule_ln_prs = {}
+        for high, y1, y2, d_ln_pr in zip(
+                self.rule_parents.tolist(), self.rule_lefts.tolist(),
+                self.rule_rights.tolist(), self.rule_ln_prs.tolist()):
+            rule_ln_prs.setdefault(self.symbols[high], {})[(self.symbols[y1], self.symbols[y2])] = d_ln_pr
+        return rule_ln_prs
+
+
+class CompiledEmissionModel(object):
+    # lexical log-probs of a compiled grammar, one CSR row per common word;
+    # the dicts of get_lexical_ln_prs are built on first use of each word
+    def __init__(self, symbols, words, word_offsets, lex_symbols, lex_ln_prs, rare_symbols, rare_ln_prs):
+        self.symbols = symbols
+        self.word_ids = {x: n for n, x in enumerate(words)}
+        self.word_offsets = word_offsets
+        self.lex_symbols = lex_symbols
+        self.lex_ln_prs = lex_ln_prs
+        self.rare_ln_prs = {
+            symbols[y]: ln_pr for y, ln_pr in zip(rare_symbols.tolist(), rare_ln_prs.tolist())
+        }
+        self.word_ln_prs = {}
+
+    def get_lexical_ln_prs(self, x):
+        # read-only, the dict is shared
+        ln_prs = self.word_ln_prs.get(x)
+        if ln_prs is not None:
+            return ln_prs
+        n = self.word_ids.get(x)
+        if n is None:
+            return self.rare_ln_prs
+        beg, end = self.word_offsets[n], self.word_offsets[n+1]
+        ln_prs = {
+            self.symbols[y]: ln_pr
+            for y, ln_pr in zip(self.lex_symbols[beg:end].tolist(), self.lex_ln_prs[beg:end].tolist())
+        }
+        self.word_ln_prs[x] = ln_prs
+        return ln_prs
+
+
+# Compiled grammar: the header holds the symbols and the common words, the arrays
+# the rules and the lexical rows.
+
+def compile_grammar(fout, binary_model, emission_model):
+    symbols = set(binary_model.nontermianl_counts) | set(emission_model.y_total_counts)
+    for high, low_ln_prs in binary_model.get_rules().items():
+        symbols.add(high)
+        for y1, y2 in low_ln_prs:
+            symbols.update((y1, y2))
+    symbols = sorted(symbols)
+    symbol_ids = {y: n for n, y in enumerate(symbols)}
+    nonterminal_counts = np.array(
+        [binary_model.nontermianl_counts.get(y, 0) for y in symbols], dtype=np.int64
+    )
+    rules = [
+        (symbol_ids[high], symbol_ids[y1], symbol_ids[y2],
+         binary_model.binary_rules[high][(y1, y2)], d_ln_pr)
+        for high, low_ln_prs in binary_model.get_rules().items()
+        for (y1, y2), d_ln_pr in low_ln_prs.items()
+    ]
+    # sorted by parent, keeping the order of the rules within a parent
+    rules.sort(key=lambda rule: rule[0])
+    parents, lefts, rights, counts, ln_prs = zip(*rules) if rules else ((),) * 5
+    rule_lefts = np.array(lefts, dtype=np.int32)
+    rule_rights = np.array(rights, dtype=np.int32)
+    # the same rules sorted by (left, right) children
+    child_order = np.lexsort((rule_rights, rule_lefts)).astype(np.int32)
+    words = sorted(emission_model.word_ln_prs)
+    word_offsets = [0]
+    lex_symbols, lex_ln_prs = [], []
+    for x in words:
+        for y, ln_pr in emission_model.word_ln_prs[x].items():
+            lex_symbols.append(symbol_ids[y])
+            lex_ln_prs.append(ln_pr)
+        word_offsets.append(len(lex_symbols))
+    rare_ln_prs = emission_model.rare_ln_prs
+    write_arrays(fout, GRAMMAR_MAGIC, GRAMMAR_VERSION, {"symbols": symbols, "words": words}, [
+        ("nonterminal_counts", nonterminal_counts),
+        ("rule_parents", np.array(parents, dtype=np.int32)),
+        ("rule_lefts", rule_lefts),
+        ("rule_rights", rule_rights),
+        ("rule_counts", np.array(counts, dtype=np.int64)),
+        ("rule_ln_prs", np.array(ln_prs, dtype=np.float64)),
+        ("child_order", child_order),
+        ("word_offsets", np.array(word_offsets, dtype=np.int64)),
+        ("lex_symbols", np.array(lex_symbols, dtype=np.int32)),
+        ("lex_ln_prs", np.array(lex_ln_prs, dtype=np.float64)),
+        ("rare_symbols", np.array([symbol_ids[y] for y in rare_ln_prs], dtype=np.int32)),
+        ("rare_ln_prs", np.array(list(rare_ln_prs.values()), dtype=np.float64)),
+    ])
+
+
+def load_grammar(fn):
+    header, arrays = map_arrays(fn, GRAMMAR_MAGIC, (GRAMMAR_VERSION,))
+    symbols = header["symbols"]
+    binary_model = CompiledBinaryModel(
+        symbols, arrays["nonterminal_counts"], arrays["rule_parents"], arrays["rule_lefts"],
+        arrays["rule_rights"], arrays["rule_counts"], arrays["rule_ln_prs"], arrays["child_order"]
+    )
+    emission_model = CompiledEmissionModel(
+        symbols, header["words"], arrays["word_offsets"], arrays["lex_symbols"],
+        arrays["lex_ln_prs"], arrays["rare_symbols"], arrays["rare_ln_prs"]
+    )
+    return binary_model, emission_model
+
+class SpanCache(object):
+    # LRU of finished chart cells keyed by the tokens of the span; a cell only depends
+    # on its tokens (and on whether it was pruned), so it can be reused across sentences
+    def __init__(self, max_length, max_entries):
+        self.max_length = max_length
+        self.max_entries = max_entries
+        self.cells = OrderedDict()
+        self.entries = 0
+        self.lookups = 0
+        self.hits = 0
+        self.saved_splits = 0
+
+    def get(self, key):
+        self.lookups += 1
+        cell = self.cells.pop(key, None)
+        if cell is None:
+            return None
+        self.cells[key] = cell
+        self.hits += 1
+        self.saved_splits += len(key[0]) - 1
+        return cell
+
+    def put(self, key, cell):
+        if key in self.cells:
+            return
+        self.cells[key] = cell
+        self.entries += len(cell[0])
+        while self.entries > self.max_entries and self.cells:
+            _, (ln_prs, _) = self.cells.popitem(last=False)
+            self.entries -= len(ln_prs)
+
+    def report(self, fout=sys.stderr):
+        hit_rate = self.hits / self.lookups if self.lookups else 0.0
+        print("span cache: lookups %d hits %d rate %.3f saved splits %d cells %d entries %d" % (
+            self.lookups, self.hits, hit_rate, self.saved_splits, len(self.cells), self.entries),
+            file=fout)
+
+
 class TreeParser(object):
     S_TAG = "SBARQ"
-    def __init__(self, binary_model, unary_model):
+    def __init__(self, binary_model, unary_model, beam_size=None, beam_threshold=None,
+                 coarse_parser=None, span_cache=None):
         self.binary_model = binary_model
         self.unary_model = unary_model
+        self.span_cache = span_cache
+        # per-cell pruning, the diagonal and the root cell are never pruned
+        self.beam_size = beam_size
+        self.beam_threshold = beam_threshold
+        # coarse-to-fine: a parser with the un-markovized grammar whose pruned chart
+        # gives the nonterminals allowed in each cell
+        self.coarse_parser = coarse_parser
+        self.coarse_symbols = {}
+        self.fine_symbols = defaultdict(list)
+        if coarse_parser:
+            for y in binary_model.get_rules():
+                self.fine_symbols[self.get_coarse_symbol(y)].append(y)
+
+    def is_pruned(self):
+        return bool(self.beam_size or self.beam_threshold is not None or self.coarse_parser)
+
+    def get_coarse_symbol(self, y):
+        coarse_y = self.coarse_symbols.get(y)
+        if coarse_y is None:
+            coarse_y = re.sub(r"\^<.*?>", "", y)
+            self.coarse_symbols[y] = coarse_y
+        return coarse_y
+
+    def get_allowed(self, coarse_cell):
+        # the parents whose coarse symbol survived in the coarse cell
+        allowed = set()
+        for coarse_y in coarse_cell:
+            allowed.update(self.fine_symbols.get(coarse_y, ()))
+        return allowed
+
+    def _prune(self, ln_prs):
+        if self.beam_threshold is not None and ln_prs:
+            min_ln_pr = max(ln_prs.values()) - self.beam_threshold
+            ln_prs = {y: v for y, v in ln_prs.items() if v >= min_ln_pr}
+        if self.beam_size and len(ln_prs) > self.beam_size:
+            ln_prs = dict(heapq.nlargest(self.beam_size, ln_prs.items(), key=lambda item: item[1]))
+        return ln_prs
 
     def parse(self, xs):
+        return self.parse_flagged(xs)[0]
+
+    def parse_flagged(self, xs):
+        # returns the tree and None, or a fallback flag when SBARQ spans no derivation
+        get_children, root, subtrees, flag = self._parse(xs)
+        if root is None:
+            return get_glue_tree(TreeParser.S_TAG, subtrees), flag
+        return build_tree(get_children, TreeParser._label, xs, root), flag
+
+    def write_parse(self, fout, xs):
+        # writes the json tree, returns the fallback flag
+        get_children, root, subtrees, flag = self._parse(xs)
+        if root is None:
+            write_glue_tree(fout, TreeParser.S_TAG, subtrees)
+        else:
+            write_tree(fout, get_children, TreeParser._label, xs, root)
+        return flag
+
+    @staticmethod
+    def _label(y):
+        return y
+
+    def _parse(self, xs):
+        # returns the children function, the root node, and the glue subtrees when there is no root
+        num = len(xs)
+        if not num:
+            return None, None, [], FALLBACK_EMPTY
+        coarse_chart = None
+        if self.coarse_parser:
+            coarse_chart, _ = self.coarse_parser.parse_chart(xs, True)
+        pi_ln_prs, back_traces = self.parse_chart(xs, self.is_pruned(), coarse_chart)
+        if TreeParser.S_TAG not in pi_ln_prs[0][num-1] and self.is_pruned():
+            # the pruning lost every root derivation, parse again without it
+            pi_ln_prs, back_traces = self.parse_chart(xs)
+        # result
+        def get_children(beg, end, tag):
+            y1, y2, b, m, e = back_traces[beg][end][tag]
+            return (b, m-1, y1), (m, e-1, y2)
+        top_cell = pi_ln_prs[0][num-1]
+        if TreeParser.S_TAG in top_cell:
+            return get_children, (0, num-1, TreeParser.S_TAG), None, None
+        if top_cell:
+            # the best derivation of any nonterminal
+            tag = max(top_cell, key=top_cell.get)
+            return get_children, (0, num-1, tag), None, FALLBACK_ROOT
+        subtrees = []
+        for n, x in enumerate(xs):
+            cell = pi_ln_prs[n][n]
+            subtrees.append([max(cell, key=cell.get) if cell else TreeParser.S_TAG, x])
+        return get_children, None, subtrees, FALLBACK_GLUE
+
+    def parse_chart(self, xs, prune=False, coarse_chart=None):
         num = len(xs)
         # π(n, m, non-terminal) represents that non-terminal spans [n, m], inclusively
         pi_ln_prs = [[{} for n in range(num)] for m in range(num)]
         back_traces = [[{} for n in range(num)] for m in range(num)]
-        # init
+        # init, diagonal cells share the lexical dicts and are never modified
         for n, x in enumerate(xs):
-            pi_ln_prs[n][n] = {
-                k: v for k, v in self.unary_model.get_state_ln_prs(x).items() if v > MIN_LN_PR
-            }
+            pi_ln_prs[n][n] = self.unary_model.get_lexical_ln_prs(x)
         # recursive
-        rule_ln_prs = self.binary_model.get_rules()
+        get_left_rules = self.binary_model.get_left_rules
+        span_cache = self.span_cache
         for length in range(2, num+1):
             for beg in range(0, num-length+1):
+                key = None
+                if span_cache and length <= span_cache.max_length:
+                    # a root cell of a pruned parse is not pruned itself but its children are
+                    key = (tuple(xs[beg:beg+length]), prune, prune and length < num)
+                    cell = span_cache.get(key)
+                    if cell is not None:
+                        # cached derivations keep the split relative to the span
+                        pi_ln_prs[beg][beg+length-1] = cell[0]
+                        back_traces[beg][beg+length-1] = {
+                            high: (y1, y2, beg, beg+split, beg+length)
+                            for high, (y1, y2, split) in cell[1].items()
+                        }
+                        continue
+                allowed = None
+                if coarse_chart and length < num:
+                    # a span the coarse parse ruled out stays empty, the others only
+                    # combine children into the parents it kept
+                    allowed = self.get_allowed(coarse_chart[beg][beg+length-1])
+                    if not allowed:
+                        continue
                 max_ln_prs = {}
                 max_derivations = {}
+                max_ranks = {}
                 for end in range(beg+1, beg+length):
                     # left [beg: end-1]
                     # right [end: beg+length-1]
-                    for high, low_ln_prs in rule_ln_prs.items():
-                        for (y1, y2), d_ln_pr in low_ln_prs.items():
-                            left_ln_pr = pi_ln_prs[beg][end-1].get(y1)
-                            if left_ln_pr is None:
+                    right_cell = pi_ln_prs[end][beg+length-1]
+                    if not right_cell:
+                        continue
+                    for y1, left_ln_pr in pi_ln_prs[beg][end-1].items():
+                        y2_rules = get_left_rules(y1)
+                        if not y2_rules:
+                            continue
+                        # join the smaller side: the right cell or the rules of y1
+                        if len(right_cell) < len(y2_rules):
+                            candidates = ((y2, y2_rules.get(y2)) for y2 in right_cell)
+                        else:
+                            candidates = y2_rules.items()
+                        for y2, rules in candidates:
+                            if not rules:
                                 continue
-                            right_ln_pr = pi_ln_prs[end][beg+length-1].get(y2)
+                            right_ln_pr = right_cell.get(y2)
                             if right_ln_pr is None:
                                 continue
-                            ln_pr = d_ln_pr + left_ln_pr + right_ln_pr
-                            if high not in max_ln_prs or max_ln_prs[high] < ln_pr:
-                                max_ln_prs[high] = ln_pr
-                                max_derivations[high] = (y1, y2, beg, end, beg+length)
+                            for high, d_ln_pr, rank in rules:
+                                if allowed is not None and high not in allowed:
+                                    continue
+                                ln_pr = d_ln_pr + left_ln_pr + right_ln_pr
+                                # ties go to the earliest split, then the earliest rule
+                                if high not in max_ln_prs or max_ln_prs[high] < ln_pr or (
+                                        max_ln_prs[high] == ln_pr and max_derivations[high][3] == end
+                                        and rank < max_ranks[high]):
+                                    max_ln_prs[high] = ln_pr
+                                    max_derivations[high] = (y1, y2, beg, end, beg+length)
+                                    max_ranks[high] = rank
+                if prune and length < num:
+                    max_ln_prs = self._prune(max_ln_prs)
                 pi_ln_prs[beg][beg+length-1] = max_ln_prs
                 back_traces[beg][beg+length-1] = max_derivations
-        # result
-        if TreeParser.S_TAG not in pi_ln_prs[0][num-1]:
-            raise "illegal grammer for %s" + " ".join(xs)
-        return TreeParser._get_tree(back_traces, xs, 0, num, TreeParser.S_TAG)
+                if key is not None:
+                    span_cache.put(key, (max_ln_prs, {
+                        high: (bp[0], bp[1], bp[3]-beg)
+                        for high, bp in max_derivations.items() if high in max_ln_prs
+                    }))
+        return pi_ln_prs, back_traces
+
+
+class ArrayTreeParser(object):
+    S_TAG = "SBARQ"
+    def __init__(self, binary_model, unary_model):
+        self.binary_model = binary_model
+        self.unary_model = unary_model
+        if isinstance(binary_model, CompiledBinaryModel):
+            # the mapped rules are already sorted by parent
+            self.symbols = binary_model.symbols
+            self.symbol_ids = binary_model.symbol_ids
+            self.rule_parents = binary_model.rule_parents
+            self.rule_lefts = binary_model.rule_lefts
+            self.rule_rights = binary_model.rule_rights
+            self.rule_ln_prs = binary_model.rule_ln_prs
+        else:
+            self._init_rules(binary_model)
+        self.parent_starts = np.flatnonzero(np.diff(self.rule_parents, prepend=-1))
+        self.parent_ids = self.rule_parents[self.parent_starts]
+        # parent group of each rule
+        self.rule_groups = np.cumsum(np.diff(self.rule_parents, prepend=-1) != 0) - 1
+        # lexical layer as sparse (ids, log-probs) vectors, made on first use of each word
+        self.rare_vector = self._to_vector(unary_model.rare_ln_prs)
+        self.word_vectors = {}
+
+    def _init_rules(self, binary_model):
+        rule_ln_prs = binary_model.get_rules()
+        symbols = set(binary_model.nontermianl_counts)
+        for high, low_ln_prs in rule_ln_prs.items():
+            symbols.add(high)
+            for y1, y2 in low_ln_prs:
+                symbols.update((y1, y2))
+        self.symbols = sorted(symbols)
+        self.symbol_ids = {y: n for n, y in enumerate(self.symbols)}
+        # rules in the order of get_rules(), so the rules of a parent are contiguous
+        parents, lefts, rights, ln_prs = [], [], [], []
+        for high, low_ln_prs in rule_ln_prs.items():
+            for (y1, y2), d_ln_pr in low_ln_prs.items():
+                parents.append(self.symbol_ids[high])
+                lefts.append(self.symbol_ids[y1])
+                rights.append(self.symbol_ids[y2])
+                ln_prs.append(d_ln_pr)
+        self.rule_parents = np.array(parents, dtype=np.int32)
+        self.rule_lefts = np.array(lefts, dtype=np.int32)
+        self.rule_rights = np.array(rights, dtype=np.int32)
+        self.rule_ln_prs = np.array(ln_prs)
+
+    def _to_vector(self, ln_prs):
+        ids = np.array([self.symbol_ids[y] for y in ln_prs], dtype=np.int32)
+        return ids, np.array(list(ln_prs.values()))
+
+    def get_word_vector(self, x):
+        vector = self.word_vectors.get(x)
+        if vector is None:
+            ln_prs = self.unary_model.get_lexical_ln_prs(x)
+            if ln_prs is self.unary_model.rare_ln_prs:
+                return self.rare_vector
+            vector = self.word_vectors[x] = self._to_vector(ln_prs)
+        return vector
+
+    def init_chart(self, xs):
+        num = len(xs)
+        # pi_ln_prs[beg, end, y]: best derivation of y spanning [beg, end], inclusively
+        pi_ln_prs = np.full((num, num, len(self.symbols)), -np.inf)
+        for n, x in enumerate(xs):
+            ids, ln_prs = self.get_word_vector(x)
+            pi_ln_prs[n, n, ids] = ln_prs
+        return pi_ln_prs
+
+    def parse_chart(self, xs):
+        num = len(xs)
+        pi_ln_prs = self.init_chart(xs)
+        # back-pointers: the rule used and the first position of the right child
+        bp_rules = np.zeros((num, num, len(self.symbols)), dtype=np.int32)
+        bp_splits = np.zeros((num, num, len(self.symbols)), dtype=np.int32)
+        rule_num = len(self.rule_ln_prs)
+        rule_ids = np.arange(rule_num)
+        for length in range(2, num+1):
+            # all spans of this length at once: begs x splits x rules
+            begs = np.arange(0, num-length+1)[:, None]
+            ends = begs + length - 1
+            splits = begs + np.arange(1, length)[None, :]
+            left_ln_prs = pi_ln_prs[begs, splits-1][:, :, self.rule_lefts]
+            right_ln_prs = pi_ln_prs[splits, ends][:, :, self.rule_rights]
+            ln_prs = self.rule_ln_prs + left_ln_prs + right_ln_prs
+            # best split per rule, then best rule per parent, earliest (split, rule) on ties
+            split_ids = ln_prs.argmax(axis=1)
+            ln_prs = ln_prs.max(axis=1)
+            max_ln_prs = np.maximum.reduceat(ln_prs, self.parent_starts, axis=1)
+            hits = (ln_prs == max_ln_prs[:, self.rule_groups]) & np.isfinite(ln_prs)
+            keys = np.where(hits, split_ids * rule_num + rule_ids, np.iinfo(np.int64).max)
+            best_keys = np.minimum.reduceat(keys, self.parent_starts, axis=1)
+            found = np.isfinite(max_ln_prs)
+            b, p = np.nonzero(found)
+            beg = begs[b, 0]
+            y = self.parent_ids[p]
+            pi_ln_prs[beg, beg+length-1, y] = max_ln_prs[b, p]
+            bp_rules[beg, beg+length-1, y] = best_keys[b, p] % rule_num
+            bp_splits[beg, beg+length-1, y] = beg + 1 + best_keys[b, p] // rule_num
+        return pi_ln_prs, bp_rules, bp_splits
+
+    def parse(self, xs):
+        return self.parse_flagged(xs)[0]
+
+    def parse_flagged(self, xs):
+        # returns the tree and None, or a fallback flag when SBARQ spans no derivation
+        get_children, root, subtrees, flag = self._parse(xs)
+        if root is None:
+            return get_glue_tree(ArrayTreeParser.S_TAG, subtrees), flag
+        return build_tree(get_children, self.symbols.__getitem__, xs, root), flag
+
+    def write_parse(self, fout, xs):
+        # writes the json tree, returns the fallback flag
+        get_children, root, subtrees, flag = self._parse(xs)
+        if root is None:
+            write_glue_tree(fout, ArrayTreeParser.S_TAG, subtrees)
+        else:
+            write_tree(fout, get_children, self.symbols.__getitem__, xs, root)
+        return flag
+
+    def _parse(self, xs):
+        # returns the children function, the root node, and the glue subtrees when there is no root
+        num = len(xs)
+        if not num:
+            return None, None, [], FALLBACK_EMPTY
+        pi_ln_prs, bp_rules, bp_splits = self.parse_chart(xs)
+        def get_children(beg, end, y):
+            rule = bp_rules[beg, end, y]
+            split = bp_splits[beg, end, y]
+            return (beg, split-1, self.rule_lefts[rule]), (split, end, self.rule_rights[rule])
+        root = self.symbol_ids.get(ArrayTreeParser.S_TAG)
+        if root is not None and np.isfinite(pi_ln_prs[0, num-1, root]):
+            return get_children, (0, num-1, root), None, None
+        top_cell = pi_ln_prs[0, num-1]
+        if np.isfinite(top_cell).any():
+            # the best derivation of any nonterminal
+            return get_children, (0, num-1, top_cell.argmax()), None, FALLBACK_ROOT
+        subtrees = []
+        for n, x in enumerate(xs):
+            cell = pi_ln_prs[n, n]
+            tag = self.symbols[cell.argmax()] if np.isfinite(cell).any() else ArrayTreeParser.S_TAG
+            subtrees.append([tag, x])
+        return get_children, None, subtrees, FALLBACK_GLUE
+
+
+
+def get_spans(tree, beg=1, spans=None, parent=None):
+    # labeled spans as counted by eval_parser.py, returns the end of the tree
+    current = re.sub(r"\^<.*?>", "", tree[0]).split("+")
+    if len(tree) == 2:
+        for y in current[:-1]:
+            spans.add((y, beg, beg))
+        return beg
+    split = get_spans(tree[1], beg, spans)
+    end = get_spans(tree[2], split + 1, spans, current[-1])
+    if current[0] != parent:
+        spans.add((current[0], beg, end))
+    for y in current[1:]:
+        spans.add((y, beg, end))
+    return end
+
+
+def report_fscore(parser, fn_seq, fn_key, fout=sys.stderr):
+    gold_cnt = test_cnt = correct_cnt = 0
+    beg = time.time()
+    with open(fn_seq) as fin:
+        with open(fn_key) as fkey:
+            for xs, line in zip(read_seqs(fin), fkey):
+                if not xs:
+                    continue
+                gold, test = set(), set()
+                get_spans(json.loads(line), 1, gold)
+                get_spans(parser.parse(xs), 1, test)
+                gold_cnt += len(gold)
+                test_cnt += len(test)
+                correct_cnt += len(gold & test)
+    precision = correct_cnt / test_cnt if test_cnt else 0.0
+    recall = correct_cnt / gold_cnt if gold_cnt else 0.0
+    fscore = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    print("precision %.3f recall %.3f F1 %.3f time %.2fs" % (precision, recall, fscore, time.time() - beg),
+          file=fout)
+
+
+# set by parse_parallel before it forks the pool, the workers read it and the mapped grammar
+_parser = None
+
+
+def _parse(item):
+    n, xs = item
+    fout = io.StringIO()
+    flag = _parser.write_parse(fout, xs)
+    return n, fout.getvalue(), flag
+
+
+def parse_parallel(parser, seqs, workers):
+    # yield the json trees and fallback flags in input order
+    global _parser
+    _parser = parser
+    pool = multiprocessing.get_context("fork").Pool(workers)
+    try:
+        for window in read_windows(seqs, PARSE_WINDOW):
+            # longest first, so no long sentence is left for the end of a window
+            order = sorted(range(len(window)), key=lambda n: -len(window[n]))
+            trees = [None] * len(window)
+            for n, tree, flag in pool.imap_unordered(_parse, [(n, window[n]) for n in order]):
+                trees[n] = tree, flag
+            for tree, flag in trees:
+                yield tree, flag
+    finally:
+        pool.terminate()
+
+
+def parse_file(parser, fn_seq, workers=0):
+    with open(fn_seq) as fin:
+        if workers:
+            results = parse_parallel(parser, read_seqs(fin), workers)
+        else:
+            # trees are written straight to stdout, the tree text is None
+            results = ((None, parser.write_parse(sys.stdout, xs)) for xs in read_seqs(fin))
+        for n, (tree, flag) in enumerate(results):
+            if tree is not None:
+                sys.stdout.write(tree)
+            sys.stdout.write("\n")
+            if flag:
+                print("WARNING: no %s derivation for sentence %d, %s fallback" % (
+                    TreeParser.S_TAG, n+1, flag), file=sys.stderr)
+        fin.close()
 
-    @staticmethod
-    def _get_tree(back_traces, xs, beg, end, tag):
-        bp = back_traces[beg][end-1].get(tag)
-        if not bp:
-            assert beg+1 == end
-            return [tag, xs[beg]]
-        y1, y2, b, m, e = bp
-        return [
-            tag,
-            TreeParser._get_tree(back_traces, xs, b, m, y1),
-            TreeParser._get_tree(back_traces, xs, m, e, y2),
-        ]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("fcount")
-    parser.add_argument("fseq")
+    parser.add_argument("fseq", nargs="?")
+    parser.add_argument("-a", "--array", action="store_true")
+    parser.add_argument("-o", "--compile", dest="fcompile", default=None)
+    parser.add_argument("-m", "--mmap", action="store_true", help="fcount and --coarse are compiled grammars")
+    parser.add_argument("-w", "--workers", type=int, default=0)
+    parser.add_argument("--beam", type=int, default=None)
+    parser.add_argument("--beam-threshold", type=float, default=None)
+    parser.add_argument("--coarse", dest="fcoarse", default=None, help="counts of the un-markovized grammar")
+    parser.add_argument("--coarse-threshold", type=float, default=10.0)
+    parser.add_argument("--report", dest="fkey", default=None, help="print F1 against this key instead of trees")
+    parser.add_argument("--span-cache", type=int, default=0, help="longest span whose cell is cached")
+    parser.add_argument("--span-cache-size", type=int, default=1000000, help="chart entries kept in the cache")
     args = parser.parse_args()
+    if args.array and (args.beam is not None or args.beam_threshold is not None or args.fcoarse or args.span_cache):
+        parser.error("--beam, --beam-threshold, --coarse and --span-cache are not supported with -a")
     fn_count = args.fcount
     fn_seq = args.fseq
-    with open(fn_count) as fin:
-        nonterminal_counts, binary_rules, unary_rules = read_counts(fin)
-    binary_model = BinaryModel(nonterminal_counts, binary_rules)
-    emission_model1 = EmissionModel1(unary_rules)
-    parser = TreeParser(binary_model, emission_model1)
-    with open(fn_seq) as fin:
-        for xs in read_seqs(fin):
-            tree = parser.parse(xs)
-            print(json.dumps(tree))
-        fin.close()
\ No newline at end of file
+    if args.mmap:
+        binary_model, emission_model1 = load_grammar(fn_count)
+    else:
+        with open(fn_count) as fin:
+            nonterminal_counts, binary_rules, unary_rules = read_counts(fin)
+        binary_model = BinaryModel(nonterminal_counts, binary_rules)
+        emission_model1 = EmissionModel1(unary_rules)
+        if args.fcompile:
+            with open(args.fcompile, "wb") as fout:
+                compile_grammar(fout, binary_model, emission_model1)
+    coarse_parser = None
+    if args.fcoarse:
+        if args.mmap:
+            coarse_binary_model, coarse_emission_model = load_grammar(args.fcoarse)
+        else:
+            with open(args.fcoarse) as fin:
+                coarse_nonterminal_counts, coarse_binary_rules, coarse_unary_rules = read_counts(fin)
+            coarse_binary_model = BinaryModel(coarse_nonterminal_counts, coarse_binary_rules)
+            coarse_emission_model = EmissionModel1(coarse_unary_rules)
+        coarse_parser = TreeParser(
+            coarse_binary_model, coarse_emission_model, beam_threshold=args.coarse_threshold,
+        )
+    if args.array:
+        parser = ArrayTreeParser(binary_model, emission_model1)
+    else:
+        span_cache = SpanCache(args.span_cache, args.span_cache_size) if args.span_cache else None
+        parser = TreeParser(
+            binary_model, emission_model1, args.beam, args.beam_threshold, coarse_parser, span_cache
+        )
+    if args.fkey:
+        report_fscore(parser, fn_seq, args.fkey)
+    elif fn_seq:
+        parse_file(parser, fn_seq, args.workers)
+    if getattr(parser, "span_cache", None) and not args.workers:
+        parser.span_cache.report()
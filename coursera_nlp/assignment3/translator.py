@@ -1,86 +1,391 @@
 # coding: utf-8
 from __future__ import division, print_function, unicode_literals
 import argparse
+import io
+import multiprocessing
+import os
 import sys
 import numpy as np
-import pickle
 import math
-from collections import defaultdict
+# the compiled model container shared by the assignments, in coursera_nlp/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from mapped_arrays import map_arrays, write_arrays
 
 
-def read_corpus(fsrc, fdst):
-    corpus_pairs = []
+def iter_corpus(fsrc, fdst):
     while True:
         src_line = fsrc.readline()
         dst_line = fdst.readline()
         if not src_line or not dst_line:
             break
-        corpus_pairs.append((src_line.split(), dst_line.split()))
-    return corpus_pairs
+        yield src_line.split(), dst_line.split()
 
 
-class WordModel(object):
+# sentence pairs scored together by one vectorized E-step
+EM_BATCH_SIZE = 1024
+MODEL_MAGIC = b"IBMMODEL"
+MODEL_VERSION = 2
+
+
+class Vocab(object):
+    def __init__(self, words=()):
+        self.words = list(words)
+        self.ids = {x: n for n, x in enumerate(self.words)}
+
+    def __len__(self):
+        return len(self.words)
+
+    def encode(self, xs, grow=True):
+        # unseen words get new ids, which have no parameters; without grow the vocab
+        # is left as it is and they all get len(self), past the last id
+        if not grow:
+            return [self.ids.get(x, len(self.words)) for x in xs]
+        ids = []
+        for x in xs:
+            n = self.ids.get(x)
+            if n is None:
+                n = self.ids[x] = len(self.words)
+                self.words.append(x)
+            ids.append(n)
+        return ids
+
+
+class Corpus(object):
+    # sentence pairs as flat int32 token ids, the k-th english sentence being
+    # src_ids[src_offsets[k]:src_offsets[k+1]], likewise for french
+    def __init__(self, src_ids, src_offsets, dst_ids, dst_offsets):
+        self.src_ids = src_ids
+        self.src_offsets = src_offsets
+        self.dst_ids = dst_ids
+        self.dst_offsets = dst_offsets
+
+    @staticmethod
+    def encode(corpus_pairs, src_vocab, dst_vocab, grow=True):
+        src_ids, dst_ids = [], []
+        src_offsets, dst_offsets = [0], [0]
+        for src, dst in corpus_pairs:
+            src_ids.extend(src_vocab.encode(src, grow))
+            dst_ids.extend(dst_vocab.encode(dst, grow))
+            src_offsets.append(len(src_ids))
+            dst_offsets.append(len(dst_ids))
+        return Corpus(
+            np.array(src_ids, dtype=np.int32), np.array(src_offsets, dtype=np.int64),
+            np.array(dst_ids, dtype=np.int32), np.array(dst_offsets, dtype=np.int64),
+        )
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    def slice(self, beg, end):
+        src_offsets = self.src_offsets[beg:end+1]
+        dst_offsets = self.dst_offsets[beg:end+1]
+        return Corpus(
+            self.src_ids[src_offsets[0]:src_offsets[-1]], src_offsets - src_offsets[0],
+            self.dst_ids[dst_offsets[0]:dst_offsets[-1]], dst_offsets - dst_offsets[0],
+        )
+
+    def batches(self, batch_size=EM_BATCH_SIZE):
+        for beg in range(0, len(self), batch_size):
+            yield self.slice(beg, min(beg + batch_size, len(self)))
+
+
+def iter_batches(corpus_pairs, batch_size=EM_BATCH_SIZE):
+    batch = []
+    for pair in corpus_pairs:
+        batch.append(pair)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_corpus_cache(fn, corpus_pairs, src_vocab, dst_vocab):
+    # one pass over the sentence pairs, appending the int32 token ids to fn.src and
+    # fn.dst and the (english, french) lengths to fn.lens, batch by batch
+    with open(fn + ".src", "wb") as fsrc, open(fn + ".dst", "wb") as fdst, open(fn + ".lens", "wb") as flens:
+        for batch in iter_batches(corpus_pairs):
+            write_corpus_batch(fsrc, fdst, flens, batch, src_vocab, dst_vocab)
+
+
+def write_corpus_batch(fsrc, fdst, flens, batch, src_vocab, dst_vocab):
+    corpus = Corpus.encode(batch, src_vocab, dst_vocab)
+    fsrc.write(corpus.src_ids.tobytes())
+    fdst.write(corpus.dst_ids.tobytes())
+    lens = np.array([np.diff(corpus.src_offsets), np.diff(corpus.dst_offsets)], dtype=np.int32)
+    flens.write(lens.T.tobytes())
+
+
+def read_corpus_cache(fn):
+    # the token ids are mapped, only the sentence offsets are read into memory
+    lens = np.fromfile(fn + ".lens", dtype=np.int32).reshape(-1, 2)
+    return Corpus(
+        map_ids(fn + ".src"), np.concatenate([[0], np.cumsum(lens[:, 0], dtype=np.int64)]),
+        map_ids(fn + ".dst"), np.concatenate([[0], np.cumsum(lens[:, 1], dtype=np.int64)]),
+    )
+
+
+def map_ids(fn):
+    # np.memmap cannot map an empty file
+    with open(fn, "rb") as fin:
+        if not fin.read(1):
+            return np.zeros(0, dtype=np.int32)
+    return np.memmap(fn, dtype=np.int32, mode="r")
+
+
+class Links(object):
+    # every (french position i, english position j) candidate of a corpus, grouped by
+    # french token; j = 0 is the NULL word, e = 0
+    def __init__(self, corpus):
+        src_lens = np.diff(corpus.src_offsets)
+        dst_lens = np.diff(corpus.dst_offsets)
+        token_sents = np.repeat(np.arange(len(corpus)), dst_lens)
+        token_is = np.arange(len(corpus.dst_ids)) - corpus.dst_offsets[token_sents] + 1
+        counts = src_lens[token_sents] + 1
+        # links of the n-th french token are starts[n]:starts[n]+counts[n]
+        self.starts = np.cumsum(counts) - counts
+        self.tokens = np.repeat(np.arange(len(corpus.dst_ids)), counts)
+        self.sent = token_sents[self.tokens]
+        self.j = np.arange(counts.sum()) - self.starts[self.tokens]
+        self.i = token_is[self.tokens]
+        self.l = src_lens[self.sent]
+        self.m = dst_lens[self.sent]
+        src_pos = corpus.src_offsets[self.sent] + self.j - 1
+        self.e = np.where(self.j > 0, corpus.src_ids[np.maximum(src_pos, 0)], 0)
+        self.f = corpus.dst_ids[self.tokens]
+
+
+def lookup(keys, values, query, default):
+    # values[k] for the sorted keys[k] == query, default where there is none
+    if not len(keys):
+        return np.full(len(query), default)
+    idx = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where(keys[idx] == query, values[idx], default)
+
+
+def unique(keys):
+    # sorted distinct keys, by sorting and comparing neighbours
+    keys = np.sort(keys)
+    return keys[np.append(True, keys[1:] != keys[:-1])] if len(keys) else keys
+
+
+def normalize(counts, groups):
+    # counts divided by the total of their group, groups being sorted
+    inverse = np.cumsum(np.append(True, groups[1:] != groups[:-1])) - 1
+    totals = np.bincount(inverse, weights=counts)
+    return counts / np.where(totals > 0, totals, 1.0)[inverse]
+
+
+def csr_lookup(offsets, cols, values, rows, query, default):
+    # values of the entries (rows[n], query[n]) of a CSR matrix whose rows have sorted
+    # cols, default where there is none; one binary search for all the queries
+    if not len(cols):
+        return np.full(len(query), default)
+    valid = rows < len(offsets) - 1
+    rows = np.where(valid, rows, 0)
+    lo = np.where(valid, offsets[rows], 0)
+    end = np.where(valid, offsets[rows+1], 0)
+    hi = end.copy()
+    last = len(cols) - 1
+    while True:
+        active = lo < hi
+        if not active.any():
+            break
+        mid = (lo + hi) // 2
+        right = active & (cols[np.minimum(mid, last)] < query)
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+    idx = np.minimum(lo, last)
+    return np.where((lo < end) & (cols[idx] == query), values[idx], default)
+
+
+class KeySet(object):
+    # sorted distinct keys added in parts, the parts are merged once they outgrow the merged keys
     def __init__(self):
-        self.ef_prs = None
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.parts = []
+        self.pending = 0
+
+    def add(self, keys):
+        keys = unique(keys)
+        self.parts.append(keys)
+        self.pending += len(keys)
+        if self.pending > len(self.keys):
+            self._merge()
+
+    def get(self):
+        self._merge()
+        return self.keys
+
+    def _merge(self):
+        if self.parts:
+            self.keys = unique(np.concatenate([self.keys] + self.parts))
+            self.parts = []
+            self.pending = 0
+
+
+class LinkIndexes(object):
+    # the indexes of IBMModel._index for the batches [beg, end) of a corpus, made
+    # batch by batch when iterated, so only one batch of links is in memory
+    def __init__(self, model, corpus, word_keys, pos_lengths, beg=0, end=None):
+        self.model = model
+        self.corpus = corpus
+        self.word_keys = word_keys
+        self.pos_lengths = pos_lengths
+        self.beg = beg
+        self.end = (len(corpus) + EM_BATCH_SIZE - 1) // EM_BATCH_SIZE if end is None else end
+
+    def __len__(self):
+        return self.end - self.beg
+
+    def __getitem__(self, batches):
+        beg, end, _ = batches.indices(len(self))
+        return LinkIndexes(
+            self.model, self.corpus, self.word_keys, self.pos_lengths, self.beg + beg, self.beg + max(beg, end)
+        )
+
+    def __iter__(self):
+        part = self.corpus.slice(self.beg * EM_BATCH_SIZE, min(self.end * EM_BATCH_SIZE, len(self.corpus)))
+        for batch in part.batches():
+            starts, batch_word_keys, pos_idx = self.model._get_keys(batch, self.pos_lengths)
+            yield starts, np.searchsorted(self.word_keys, batch_word_keys), pos_idx
+
+
+class WordModel(object):
+    # t(f|e) over the observed (e, f) pairs as a CSR matrix: the row of e is
+    # dst_ids[offsets[e]:offsets[e+1]], sorted, with the probabilities prs
+    def __init__(self, src_vocab=None, dst_vocab=None, offsets=None, dst_ids=None, prs=None):
+        self.src_vocab = src_vocab or Vocab([None])
+        self.dst_vocab = dst_vocab or Vocab()
+        self.offsets = offsets
+        self.dst_ids = dst_ids
+        self.prs = prs
 
     def is_initialized(self):
-        return bool(self.ef_prs)
+        return self.prs is not None
+
+    def encode(self, corpus_pairs, grow=True):
+        return Corpus.encode(corpus_pairs, self.src_vocab, self.dst_vocab, grow)
 
-    def update(self, ef_counts):
-        prs = {}
-        for e, f_cnts in ef_counts.items():
-            scale = 1.0 / sum(f_cnts.values())
-            prs[e] = {f: cnt*scale for f, cnt in f_cnts.items()}
-        self.ef_prs = prs
+    def get_keys(self, links):
+        # e << 32 | f, sorted the same way as the CSR entries
+        return links.e.astype(np.int64) << 32 | links.f
+
+    def get_prs(self, keys):
+        if self.prs is None:
+            return np.ones(len(keys))
+        return csr_lookup(self.offsets, self.dst_ids, self.prs, keys >> 32, keys & 0xffffffff, 0.0)
+
+    def update(self, keys, counts):
+        # keys are sorted
+        self.offsets = np.searchsorted(keys >> 32, np.arange(len(self.src_vocab) + 1))
+        self.dst_ids = (keys & 0xffffffff).astype(np.int32)
+        self.prs = normalize(counts, keys >> 32)
 
     def get_pr(self, e, f):
-        if not self.ef_prs:
+        if self.prs is None:
             return 1.0
-        f_prs = self.ef_prs.get(e)
-        if f_prs:
-            return f_prs.get(f, 0.0)
-        return 0.0
+        e = self.src_vocab.ids.get(e)
+        f = self.dst_vocab.ids.get(f)
+        if e is None or f is None:
+            return 0.0
+        return float(self.get_prs(np.array([e << 32 | f], dtype=np.int64))[0])
 
 
 class MockPositionModel(object):
-    def update(self, _):
+    def get_lengths(self, corpus):
+        return None
+
+    def get_link_prs(self, links):
+        return None
+
+    def update(self, lengths, counts):
         pass
 
     def get_pr(self, el, fm, e_j, f_i):
         return 1.0
 
+
+def get_starts(lengths):
+    # offsets of the m x (l+1) blocks of the sorted lengths[b] = m << 32 | l, and their end
+    sizes = (lengths >> 32) * ((lengths & 0xffffffff) + 1)
+    return np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+
+
 class PositionModel(object):
+    # q(j|i,l,m) as one dense block per (l, m) pair: the block of lengths[b] is
+    # prs[starts[b]:starts[b+1]], row i-1 and column j of an m x (l+1) matrix.
+    # With min_count, the pairs seen in fewer sentences have no block and get the
+    # diagonal of get_diagonal_prs, otherwise unseen pairs are uniform.
     # fm: french length m
     # el: english length l
-    def __init__(self):
-        self.fm_el_fe_prs = None
-
-    def update(self, fe_pos_counts):
-        fm_el_fe_prs = {}
-        for fm, el_fe_cnts in fe_pos_counts.items():
-            el_fe_prs = {}
-            fm_el_fe_prs[fm] = el_fe_prs
-            for el, fe_cnts in el_fe_cnts.items():
-                fe_prs = {}
-                el_fe_prs[el] = fe_prs
-                for f, e_cnts in fe_cnts.items():
-                    scale = 1.0 / sum(e_cnts.values())
-                    fe_prs[f] = {e: cnt*scale for e, cnt in e_cnts.items()}
-        self.fm_el_fe_prs = fm_el_fe_prs
+    def __init__(self, lengths=None, prs=None, min_count=0):
+        self.lengths = lengths
+        self.prs = prs
+        self.starts = get_starts(lengths) if lengths is not None else None
+        self.min_count = min_count
+
+    def get_lengths(self, corpus):
+        return unique(np.diff(corpus.dst_offsets) << 32 | np.diff(corpus.src_offsets))
+
+    def get_index(self, lengths, links):
+        # position of each link in the blocks of lengths
+        blocks = np.searchsorted(lengths, links.m << 32 | links.l)
+        return get_starts(lengths)[blocks] + (links.i - 1) * (links.l + 1) + links.j
+
+    def get_prs(self, lengths):
+        # the blocks of lengths, from the model where it has them
+        starts = get_starts(lengths)
+        if self.prs is None:
+            return np.ones(starts[-1])
+        blocks = np.repeat(np.arange(len(lengths)), np.diff(starts))
+        cells = np.arange(starts[-1]) - starts[blocks]
+        if self.min_count:
+            prs = get_diagonal_prs(lengths[blocks] >> 32, lengths[blocks] & 0xffffffff, cells)
+        else:
+            prs = np.ones(starts[-1])
+        own = lookup(self.lengths, np.arange(len(self.lengths)), lengths, -1)[blocks]
+        has = own >= 0
+        prs[has] = self.prs[self.starts[own[has]] + cells[has]]
+        return prs
+
+    def get_link_prs(self, links):
+        lengths = unique(links.m[links.starts] << 32 | links.l[links.starts])
+        return self.get_prs(lengths)[self.get_index(lengths, links)]
+
+    def update(self, lengths, counts):
+        # counts are laid out as the blocks of lengths; each row sums to the number of
+        # sentences with those lengths
+        ms = lengths >> 32
+        ls = lengths & 0xffffffff
+        row_sizes = np.repeat(ls + 1, ms)
+        totals = np.add.reduceat(counts, np.cumsum(row_sizes) - row_sizes)
+        prs = counts / np.repeat(np.where(totals > 0, totals, 1.0), row_sizes)
+        keep = totals[np.cumsum(ms) - ms] >= self.min_count
+        self.lengths = lengths[keep]
+        self.prs = prs[np.repeat(keep, ms * (ls + 1))]
+        self.starts = get_starts(self.lengths)
 
     def get_pr(self, el, fm, e_j, f_i):
-        if not self.fm_el_fe_prs:
-            return 1.0
-        el_fe_prs = self.fm_el_fe_prs.get(fm)
-        if not el_fe_prs:
-            return 1.0
-        fe_prs = el_fe_prs.get(el)
-        if not fe_prs:
-            return 1.0
-        e_prs = fe_prs.get(f_i)
-        if not e_prs:
-            return 1.0 / (el + 1)
-        return e_prs.get(e_j, 0.0)
+        prs = self.get_prs(np.array([fm << 32 | el], dtype=np.int64))
+        return float(prs[(f_i - 1) * (el + 1) + e_j])
+
+
+# fast_align-style diagonal: q(0|i) = DIAGONAL_NULL_PR, q(j|i) proportional to
+# exp(-DIAGONAL_TENSION * |i/m - j/l|) for the other positions
+DIAGONAL_TENSION = 4.0
+DIAGONAL_NULL_PR = 0.08
+
+
+def get_diagonal_prs(ms, ls, cells):
+    # cells of m x (l+1) blocks, ms and ls per cell
+    i = cells // (ls + 1) + 1
+    j = cells % (ls + 1)
+    weights = np.where(j > 0, np.exp(-DIAGONAL_TENSION * np.abs(i / ms - j / np.maximum(ls, 1))), 0.0)
+    row_starts = np.flatnonzero(j == 0)
+    totals = np.add.reduceat(weights, row_starts) if len(row_starts) else weights
+    totals = np.repeat(np.where(totals > 0, totals, 1.0), ls[row_starts] + 1)
+    return np.where(j == 0, DIAGONAL_NULL_PR, (1 - DIAGONAL_NULL_PR) * weights / totals)
 
 
 class IBMModel(object):
@@ -88,58 +393,333 @@ class IBMModel(object):
         self.word_model = word_model
         self.pos_model = pos_model
 
-    def _update(self, corpus):
+    def _get_keys(self, batch, pos_lengths):
+        links = Links(batch)
+        pos_idx = self.pos_model.get_index(pos_lengths, links) if pos_lengths is not None else None
+        return links.starts, self.word_model.get_keys(links), pos_idx
+
+    def _index(self, corpus, stream=False):
+        # the batches as indexes into the sorted word keys and into the position blocks
+        # of the length pairs of the corpus; streamed indexes are made again at every iteration
+        pos_lengths = self.pos_model.get_lengths(corpus)
+        word_keys = KeySet()
+        batches = []
+        for batch in corpus.batches():
+            if stream:
+                word_keys.add(self.word_model.get_keys(Links(batch)))
+                continue
+            starts, batch_word_keys, pos_idx = self._get_keys(batch, pos_lengths)
+            batches.append((starts, batch_word_keys, pos_idx))
+            word_keys.add(batch_word_keys)
+        word_keys = word_keys.get()
+        if stream:
+            return word_keys, pos_lengths, LinkIndexes(self, corpus, word_keys, pos_lengths)
+        indexes = [
+            (starts, np.searchsorted(word_keys, batch_word_keys), pos_idx)
+            for starts, batch_word_keys, pos_idx in batches
+        ]
+        return word_keys, pos_lengths, indexes
+
+    @staticmethod
+    def _expect(word_prs, pos_prs, indexes):
+        # expected counts of the word and position keys over some batches
         total_cnt = 0
         total_pr = 0
-        ef_counts = defaultdict(lambda: defaultdict(int))
-        fe_pos_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(int))))
-        for n, (src, dst) in enumerate(corpus):
-            el = len(src)
-            fm = len(dst)
-            for i, f in enumerate(dst):
-                likelihood = np.zeros(el + 1)
-                likelihood[0] = self.word_model.get_pr(None, f) * self.pos_model.get_pr(el, fm, 0, i+1)
-                for j, e in enumerate(src):
-                    likelihood[j+1] = self.word_model.get_pr(e, f) * self.pos_model.get_pr(el, fm, j+1, i+1)
-                scale = 1.0 / likelihood.sum()
-                deltas = scale * likelihood
-                ef_counts[None][f] += deltas[0]
-                fe_pos_counts[fm][el][i+1][0] += deltas[0]
-                for j, e in enumerate(src):
-                    ef_counts[e][f] += deltas[j+1]
-                    fe_pos_counts[fm][el][i+1][j+1] += deltas[j+1]
-                for j, pr in enumerate(likelihood):
-                    if likelihood[j] > 0:
-                        total_pr += deltas[j] * math.log(likelihood[j])
-                total_cnt += 1
-        self.word_model.update(ef_counts)
-        self.pos_model.update(fe_pos_counts)
+        ef_counts = np.zeros(len(word_prs))
+        fe_pos_counts = np.zeros(len(pos_prs)) if pos_prs is not None else None
+        for starts, word_idx, pos_idx in indexes:
+            # gather, normalize over the english positions of each french token, scatter-add
+            likelihood = word_prs[word_idx]
+            if pos_idx is not None:
+                likelihood *= pos_prs[pos_idx]
+            totals = np.add.reduceat(likelihood, starts)
+            # a french token none of whose links has a probability (a pruned model) is skipped
+            covered = totals > 0
+            deltas = likelihood / np.repeat(np.where(covered, totals, 1.0), np.diff(np.append(starts, len(likelihood))))
+            ef_counts += np.bincount(word_idx, weights=deltas, minlength=len(word_prs))
+            if pos_idx is not None:
+                fe_pos_counts += np.bincount(pos_idx, weights=deltas, minlength=len(pos_prs))
+            positive = likelihood > 0
+            total_pr += np.dot(deltas[positive], np.log(likelihood[positive]))
+            total_cnt += np.count_nonzero(covered)
+        return ef_counts, fe_pos_counts, total_pr, total_cnt
+
+    def _update(self, word_keys, pos_lengths, indexes, workers=0):
+        word_prs = self.word_model.get_prs(word_keys)
+        pos_prs = self.pos_model.get_prs(pos_lengths) if pos_lengths is not None else None
+        if workers:
+            partials = expect_parallel(word_prs, pos_prs, indexes, workers)
+        else:
+            partials = [IBMModel._expect(word_prs, pos_prs, indexes)]
+        # reduce
+        ef_counts, fe_pos_counts, total_pr, total_cnt = partials[0]
+        for partial_ef_counts, partial_fe_pos_counts, partial_pr, partial_cnt in partials[1:]:
+            ef_counts += partial_ef_counts
+            if fe_pos_counts is not None:
+                fe_pos_counts += partial_fe_pos_counts
+            total_pr += partial_pr
+            total_cnt += partial_cnt
+        if not total_cnt:
+            raise Exception("no french token has a translation probability")
+        if not np.isfinite(ef_counts).all() or (fe_pos_counts is not None and not np.isfinite(fe_pos_counts).all()):
+            raise Exception("non-finite expected counts")
+        self.word_model.update(word_keys, ef_counts)
+        if pos_lengths is not None:
+            self.pos_model.update(pos_lengths, fe_pos_counts)
         return math.exp(total_pr / total_cnt)
 
-    def fit(self, corpus, itr_num=5):
+    def fit(self, corpus_pairs, itr_num=5, workers=0, cache=None):
+        # with cache, the encoded corpus is written there and streamed from it
+        if cache:
+            write_corpus_cache(cache, corpus_pairs, self.word_model.src_vocab, self.word_model.dst_vocab)
+            corpus = read_corpus_cache(cache)
+        else:
+            corpus = self.word_model.encode(corpus_pairs)
+        word_keys, pos_lengths, indexes = self._index(corpus, stream=bool(cache))
         if not self.word_model.is_initialized():
             print("initializing", file=sys.stderr)
-            self._update(corpus)
+            self._update(word_keys, pos_lengths, indexes, workers)
         for itr in range(itr_num):
             print("iteration", itr, "word-pr", file=sys.stderr, end=" ")
-            print(self._update(corpus), file=sys.stderr)
+            print(self._update(word_keys, pos_lengths, indexes, workers), file=sys.stderr)
         return
 
-    def get_alignment(self, corpus):
-        results = []
-        for n, (src, dst) in enumerate(corpus):
-            el = len(src)
-            fm = len(dst)
-            for i, f in enumerate(dst):
-                max_pr = self.word_model.get_pr(None, f) * self.pos_model.get_pr(el, fm, 0, i+1)
-                max_index = 0
-                for j, e in enumerate(src):
-                    pr = self.word_model.get_pr(e, f) * self.pos_model.get_pr(el, fm, j+1, i+1)
-                    if pr > max_pr:
-                        max_pr = pr
-                        max_index = j + 1
-                results.append((n+1, max_index, i + 1))
-        return results
+    def get_likelihood(self, links):
+        likelihood = self.word_model.get_prs(self.word_model.get_keys(links))
+        pos_prs = self.pos_model.get_link_prs(links)
+        if pos_prs is not None:
+            likelihood *= pos_prs
+        return likelihood
+
+    def get_alignment(self, corpus_pairs):
+        # yield the (sentence, english position, french position) of the most likely
+        # link of each french token, reading and aligning a batch of sentences at a time
+        # unseen words are not added to the vocab, their links have no probability
+        n = 0
+        for pairs in iter_batches(corpus_pairs):
+            links = Links(self.word_model.encode(pairs, grow=False))
+            likelihood = self.get_likelihood(links)
+            # the first link of each french token that reaches the token's maximum
+            maxes = np.maximum.reduceat(likelihood, links.starts) if len(likelihood) else likelihood
+            best = np.flatnonzero(likelihood == maxes[links.tokens])
+            best = best[np.append(True, links.tokens[best[1:]] != links.tokens[best[:-1]])] if len(best) else best
+            for sent, j, i in zip((links.sent[best] + n + 1).tolist(), links.j[best].tolist(), links.i[best].tolist()):
+                yield sent, j, i
+            n += len(pairs)
+
+
+# Stored model: the arrays go through mapped_arrays; the vocabularies are text files
+# next to it, one word per line in id order, the english one without NULL (id 0).
+# Version 1 kept q(j|i,l,m) sparse, as prs of the sorted pos_keys = m << 48 | l << 32 |
+# i << 16 | j with pos_lengths = m << 16 | l; version 2 keeps the dense blocks.
+
+def write_vocab(fn, words):
+    with io.open(fn, "w", encoding="utf8") as fout:
+        for x in words:
+            fout.write(x + "\n")
+
+
+def read_vocab(fn):
+    with io.open(fn, encoding="utf8") as fin:
+        return [line.rstrip("\n") for line in fin]
+
+
+def store_model(fn, word_model, pos_model, threshold=0.0):
+    # translation probabilities not above threshold are pruned, the rest kept as float32
+    if not np.isfinite(word_model.prs).all():
+        raise Exception("non-finite translation probabilities, not storing %s" % fn)
+    keep = word_model.prs > threshold
+    rows = np.repeat(np.arange(len(word_model.offsets) - 1), np.diff(word_model.offsets))
+    arrays = [
+        ("offsets", np.searchsorted(rows[keep], np.arange(len(word_model.offsets))).astype(np.int64)),
+        ("dst_ids", word_model.dst_ids[keep]),
+        ("prs", word_model.prs[keep].astype(np.float32)),
+    ]
+    header = {"threshold": threshold}
+    if getattr(pos_model, "prs", None) is not None:
+        header["min_count"] = pos_model.min_count
+        arrays += [
+            ("pos_lengths", pos_model.lengths),
+            ("pos_prs", pos_model.prs.astype(np.float32)),
+        ]
+    with open(fn, "wb") as fout:
+        write_arrays(fout, MODEL_MAGIC, MODEL_VERSION, header, arrays)
+    write_vocab(fn + ".src.vocab", word_model.src_vocab.words[1:])
+    write_vocab(fn + ".dst.vocab", word_model.dst_vocab.words)
+
+
+def get_v1_blocks(keys, prs, lengths):
+    # the dense blocks of a version 1 position model, 0 where it had no key
+    ms = lengths >> 16
+    ls = lengths & 0xffff
+    blocks = ms << 32 | ls
+    starts = get_starts(blocks)
+    k = np.searchsorted(lengths, keys >> 32)
+    dense = np.zeros(starts[-1], dtype=prs.dtype)
+    dense[starts[k] + ((keys >> 16 & 0xffff) - 1) * (ls[k] + 1) + (keys & 0xffff)] = prs
+    return blocks, dense
+
+
+def load_model(fn):
+    # the position model is None when only t(f|e) was stored
+    header, arrays = map_arrays(fn, MODEL_MAGIC, (1, MODEL_VERSION))
+    word_model = WordModel(
+        Vocab([None] + read_vocab(fn + ".src.vocab")), Vocab(read_vocab(fn + ".dst.vocab")),
+        arrays["offsets"], arrays["dst_ids"], arrays["prs"]
+    )
+    pos_model = None
+    if "pos_keys" in arrays:
+        pos_model = PositionModel(*get_v1_blocks(arrays["pos_keys"], arrays["pos_prs"], arrays["pos_lengths"]))
+    elif "pos_lengths" in arrays:
+        pos_model = PositionModel(arrays["pos_lengths"], arrays["pos_prs"], header["min_count"])
+    return word_model, pos_model
+
+
+# (word_prs, pos_prs, indexes) of the current E-step, seen by the workers of a fork pool
+_em_state = None
+
+
+def _expect_shard(shard):
+    word_prs, pos_prs, indexes = _em_state
+    beg, end = shard
+    return IBMModel._expect(word_prs, pos_prs, indexes[beg:end])
+
+
+def expect_parallel(word_prs, pos_prs, indexes, workers):
+    # partial expected counts of contiguous shards of the batches, in shard order
+    global _em_state
+    _em_state = word_prs, pos_prs, indexes
+    shards = [(n * len(indexes) // workers, (n+1) * len(indexes) // workers) for n in range(workers)]
+    pool = multiprocessing.get_context("fork").Pool(workers)
+    try:
+        return pool.map(_expect_shard, [(beg, end) for beg, end in shards if beg < end])
+    finally:
+        pool.terminate()
+        _em_state = None
+
+
+def make_model(args, load):
+    pos_model = None
+    if load:
+        word_model, pos_model = load_model(load)
+    else:
+        word_model = WordModel()
+    if args.model == 1:
+        return IBMModel(word_model, MockPositionModel())
+    if pos_model is None:
+        pos_model = PositionModel()
+    if args.diagonal is not None:
+        pos_model.min_count = args.diagonal
+    return IBMModel(word_model, pos_model)
+
+
+# Symmetrization: the english-to-french and french-to-english models are trained and
+# aligned in two processes; the links of both are (sentence, english, french) rows,
+# NULL links dropped, sorted by sentence, then english, then french.
+
+NEIGHBOURS = [(-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+
+def sort_links(links):
+    # distinct rows in (sentence, english, french) order
+    links = links[np.lexsort(links.T[::-1])]
+    return links[np.append(True, (links[1:] != links[:-1]).any(axis=1))] if len(links) else links
+
+
+def merge_links(forward, backward):
+    # the union of two sets of distinct rows, and which of its rows are in both
+    links = np.concatenate([forward, backward])
+    if not len(links):
+        return links, np.zeros(0, dtype=bool)
+    links = links[np.lexsort(links.T[::-1])]
+    starts = np.flatnonzero(np.append(True, (links[1:] != links[:-1]).any(axis=1)))
+    return links[starts], np.diff(np.append(starts, len(links))) > 1
+
+
+def run_direction(args, reverse, conn):
+    # the files of the french-to-english model get a ".rev" suffix
+    def path(fn):
+        return fn + ".rev" if fn and reverse else fn
+    model = make_model(args, path(args.load))
+    fsrc, fdst = (args.fdst, args.fsrc) if reverse else (args.fsrc, args.fdst)
+    if args.update:
+        with open(fsrc) as fin_src, open(fdst) as fin_dst:
+            model.fit(iter_corpus(fin_src, fin_dst), workers=args.workers, cache=path(args.cache))
+        if args.store:
+            store_model(path(args.store), model.word_model, model.pos_model, args.prune)
+    fsrc, fdst = args.align or (args.fsrc, args.fdst)
+    if reverse:
+        fsrc, fdst = fdst, fsrc
+    with open(fsrc) as fin_src, open(fdst) as fin_dst:
+        links = np.array(list(model.get_alignment(iter_corpus(fin_src, fin_dst))), dtype=np.int64).reshape(-1, 3)
+    if reverse:
+        links = links[:, [0, 2, 1]]
+    conn.send(sort_links(links[(links[:, 1] > 0) & (links[:, 2] > 0)]))
+    conn.close()
+
+
+def align_both(args):
+    # the links of both directions
+    conns, processes = [], []
+    for reverse in (False, True):
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_direction, args=(args, reverse, child_conn))
+        process.start()
+        child_conn.close()
+        conns.append(parent_conn)
+        processes.append(process)
+    try:
+        # a direction that fails closes its pipe without sending
+        return [conn.recv() for conn in conns]
+    finally:
+        for process in processes:
+            process.join()
+
+
+def grow_diag_final(intersection, union):
+    # links of one sentence as sets of (english, french)
+    links = set(intersection)
+    es = {e for e, f in links}
+    fs = {f for e, f in links}
+    added = True
+    while added:
+        added = False
+        for e, f in sorted(links):
+            for de, df in NEIGHBOURS:
+                link = (e + de, f + df)
+                if link in union and link not in links and (link[0] not in es or link[1] not in fs):
+                    links.add(link)
+                    es.add(link[0])
+                    fs.add(link[1])
+                    added = True
+    for e, f in sorted(union):
+        if e not in es or f not in fs:
+            links.add((e, f))
+            es.add(e)
+            fs.add(f)
+    return links
+
+
+def symmetrize(forward, backward, heuristic):
+    union_links, both = merge_links(forward, backward)
+    inter_links = union_links[both]
+    if heuristic == "intersection":
+        return inter_links
+    if heuristic == "union":
+        return union_links
+    results = []
+    # the links are sorted, so each sentence is a range of rows
+    sents = union_links[:, 0]
+    begs = np.flatnonzero(np.append(True, sents[1:] != sents[:-1])) if len(sents) else sents
+    for beg, end in zip(begs.tolist(), np.append(begs[1:], len(sents)).tolist()):
+        n = int(sents[beg])
+        inter_beg, inter_end = np.searchsorted(inter_links[:, 0], [n, n + 1])
+        links = grow_diag_final(
+            [tuple(link) for link in inter_links[inter_beg:inter_end, 1:].tolist()],
+            {tuple(link) for link in union_links[beg:end, 1:].tolist()},
+        )
+        results.extend((n, e, f) for e, f in sorted(links))
+    return np.array(results, dtype=np.int64).reshape(-1, 3)
 
 
 if __name__ == "__main__":
@@ -150,30 +730,32 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--load", default=None)
     parser.add_argument("-u", "--update", action="store_true")
     parser.add_argument("-m", "--model", type=int, default=2)
+    parser.add_argument("-w", "--workers", type=int, default=0)
+    parser.add_argument("-c", "--cache", default=None, help="stream the training corpus from this encoded copy")
+    parser.add_argument("-d", "--diagonal", type=int, default=None,
+                        help="length pairs seen in fewer sentences get a diagonal q(j|i,l,m)")
+    parser.add_argument("-p", "--prune", type=float, default=0.0, help="drop stored t(f|e) not above this")
+    parser.add_argument("--symmetrize", choices=["intersection", "union", "grow-diag-final"], default=None,
+                        help="align with the models of both directions, stored as FILE and FILE.rev")
+    parser.add_argument("--align", nargs=2, default=None, metavar=("FSRC", "FDST"),
+                        help="the sentence pairs to symmetrize, by default fsrc and fdst")
     args = parser.parse_args()
 
-    if args.load:
-        with open(args.load, "rb") as fmodel:
-            word_model = pickle.load(fmodel)
-    else:
-        word_model = WordModel()
-    model = None
-    if args.model == 1:
-        model = IBMModel(word_model, MockPositionModel())
-    elif args.model == 2:
-        model = IBMModel(word_model, PositionModel())
-    else:
+    if args.model not in (1, 2):
         print("Only support model 1 and 2", file=sys.stderr)
         exit()
+    if args.symmetrize:
+        for n, e_j, f_i in symmetrize(*align_both(args), heuristic=args.symmetrize).tolist():
+            print(n, e_j, f_i)
+        exit()
+    model = make_model(args, args.load)
     with open(args.fsrc) as fsrc:
         with open(args.fdst) as fdst:
-            corpus = read_corpus(fsrc, fdst)
+            corpus = iter_corpus(fsrc, fdst)
             if args.update:
-                model.fit(corpus)
+                model.fit(corpus, workers=args.workers, cache=args.cache)
             else:
-                results = model.get_alignment(corpus)
-                for index, e_j, f_i in results:
+                for index, e_j, f_i in model.get_alignment(corpus):
                     print(index, e_j, f_i)
     if args.store:
-        with open(args.store, "wb") as fmodel:
-            pickle.dump(word_model, fmodel)
+        store_model(args.store, model.word_model, model.pos_model, args.prune)
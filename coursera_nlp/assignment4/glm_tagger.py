@@ -1,6 +1,8 @@
 from __future__ import division, print_function, generators
 from collections import defaultdict
 import argparse
+import heapq
+import os
 import sys
 
 
@@ -43,6 +45,13 @@ def read_seq_tags(fin):
         yield xs, tags
 
 
+def write_tags(xs, ys, fout=sys.stdout):
+    assert len(xs) == len(ys)
+    for n, x in enumerate(xs):
+        print(x, ys[n], file=fout)
+    print(file=fout)
+
+
 class GLM(object):
     def __init__(self):
         self.weights = {}
@@ -119,9 +128,20 @@ class SuffixModel(object):
 
 class ViterbiDecoder(object):
     STATE_STOP = "STOP"
-    def __init__(self, states, model):
+    def __init__(self, states, model, beam_size=None, beam_threshold=None):
         self.states = states
         self.model = model
+        # with a beam only the best (tag, tag) histories are kept at each position
+        self.beam_size = beam_size
+        self.beam_threshold = beam_threshold
+
+    def _prune(self, lnprs):
+        if self.beam_threshold is not None:
+            min_lnpr = max(lnprs.values()) - self.beam_threshold
+            lnprs = {s: lnpr for s, lnpr in lnprs.items() if lnpr >= min_lnpr}
+        if self.beam_size and len(lnprs) > self.beam_size:
+            lnprs = dict(heapq.nlargest(self.beam_size, lnprs.items(), key=lambda item: item[1]))
+        return lnprs
 
     def decode(self, xs):
         last_lnprs = {("*", "*"): 0.0}
@@ -136,6 +156,8 @@ class ViterbiDecoder(object):
                     if new_s not in max_lgprs or max_lgprs[new_s] < lnpr:
                         max_lgprs[new_s] = lnpr
                         max_states[new_s] = last_s
+            if self.beam_size or self.beam_threshold is not None:
+                max_lgprs = self._prune(max_lgprs)
             last_lnprs = max_lgprs
             back_traces.append(max_states)
         # end of states
@@ -174,22 +196,39 @@ class GLMTrainer(object):
         return self.model
 
 
-def load_decode(fn_load, fn_seq):
+def load_decode(fn_load, fn_seq, beam_size=None, beam_threshold=None):
     glm = GLM()
     if fn_load:
         with open(args.load) as fin:
             glm.load(fin)
-    decoder = ViterbiDecoder(["O", "I-GENE"], SuffixModel(glm))
+    decoder = ViterbiDecoder(["O", "I-GENE"], SuffixModel(glm), beam_size, beam_threshold)
     with open(fn_seq) as fin:
         for xs in read_seqs(fin):
-            ys = decoder.decode(xs)
-            assert len(xs) == len(ys)
-            for n, x in enumerate(xs):
-                print(x, ys[n])
-            print()
+            write_tags(xs, decoder.decode(xs))
         fin.close()
 
 
+def import_gene_tagger():
+    # the serve loop and the beam report live in gene_tagger.py of assignment 1,
+    # imported on demand so training and decoding do not need numpy
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "assignment1")
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    import gene_tagger
+    return gene_tagger
+
+
+def load_compare(fn_load, fn_seq, beam_size, beam_threshold):
+    glm = GLM()
+    with open(fn_load) as fin:
+        glm.load(fin)
+    model = SuffixModel(glm)
+    exact_decoder = ViterbiDecoder(["O", "I-GENE"], model)
+    decoder = ViterbiDecoder(["O", "I-GENE"], model, beam_size, beam_threshold)
+    with open(fn_seq) as fin:
+        import_gene_tagger().compare_decoders(exact_decoder, decoder, read_seqs(fin))
+
+
 def train_store(fn_seq_tag, fn_store):
     with open(fn_seq_tag) as fin:
         seq_tags = list(read_seq_tags(fin))
@@ -199,14 +238,40 @@ def train_store(fn_seq_tag, fn_store):
             model.glm.store(fout)
 
 
+def load_serve(fn_load, workers, batch_size, max_wait, socket_path=None,
+               beam_size=None, beam_threshold=None):
+    # decode sentences from stdin, or from each connection to a unix socket, until end of input
+    glm = GLM()
+    with open(fn_load) as fin:
+        glm.load(fin)
+    decoder = ViterbiDecoder(["O", "I-GENE"], SuffixModel(glm), beam_size, beam_threshold)
+    import_gene_tagger().serve(decoder, workers, batch_size, max_wait, socket_path)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-l", "--load")
     parser.add_argument("-s", "--store")
-    parser.add_argument("fseq")
+    parser.add_argument("fseq", nargs="?")
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--socket", default=None)
+    parser.add_argument("-w", "--workers", type=int, default=0)
+    parser.add_argument("-b", "--batch", type=int, default=1)
+    parser.add_argument("--max-wait", type=float, default=10.0, help="micro-batch latency bound in ms")
+    parser.add_argument("--beam", type=int, default=None)
+    parser.add_argument("--beam-threshold", type=float, default=None)
+    parser.add_argument("--beam-report", action="store_true")
     args = parser.parse_args()
+    if (args.serve or args.beam_report) and not args.load:
+        parser.error("--serve and --beam-report need -l")
 
-    if args.load:
-        load_decode(args.load, args.fseq)
+    if args.beam_report:
+        load_compare(args.load, args.fseq, args.beam, args.beam_threshold)
+    elif args.serve:
+        load_serve(
+            args.load, args.workers, args.batch, args.max_wait / 1000.0, args.socket, args.beam, args.beam_threshold
+        )
+    elif args.load:
+        load_decode(args.load, args.fseq, args.beam, args.beam_threshold)
     elif args.store:
         train_store(args.fseq, args.store)
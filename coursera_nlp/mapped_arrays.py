@@ -0,0 +1,53 @@
+# coding: utf-8
+from __future__ import division
+import json
+import struct
+import numpy as np
+
+# Compiled model files of the assignments: a magic naming the kind of model, the header
+# length, a json header (version, the model's own fields and the array layout), then
+# each array aligned to ALIGNMENT. The arrays are read-only views of one np.memmap, so
+# worker processes forked after loading share one copy of them.
+
+ALIGNMENT = 64
+
+
+def _aligned(size):
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_arrays(fout, magic, version, header, arrays):
+    # arrays is a list of (name, array)
+    header = dict(header, version=version, arrays={})
+    offset = 0
+    for name, array in arrays:
+        header["arrays"][name] = {
+            "offset": offset, "dtype": array.dtype.str, "shape": list(array.shape)
+        }
+        offset += _aligned(array.nbytes)
+    data = json.dumps(header).encode("utf8")
+    prefix = magic + struct.pack("<Q", len(data)) + data
+    fout.write(prefix + b"\0" * (_aligned(len(prefix)) - len(prefix)))
+    for name, array in arrays:
+        data = np.ascontiguousarray(array).tobytes()
+        fout.write(data + b"\0" * (_aligned(len(data)) - len(data)))
+
+
+def map_arrays(fn, magic, versions):
+    # the header and the arrays by name; versions are the ones the caller can read
+    buf = np.memmap(fn, dtype=np.uint8, mode="r")
+    if bytes(buf[:len(magic)]) != magic:
+        raise Exception("not a %s file %s" % (magic.decode("ascii"), fn))
+    beg = len(magic) + 8
+    size = struct.unpack("<Q", bytes(buf[len(magic):beg]))[0]
+    header = json.loads(bytes(buf[beg:beg+size]).decode("utf8"))
+    if header["version"] not in versions:
+        raise Exception("unsupported %s version %s" % (magic.decode("ascii"), header["version"]))
+    base = _aligned(beg + size)
+    arrays = {}
+    for name, desc in header["arrays"].items():
+        dtype = np.dtype(desc["dtype"])
+        offset = base + desc["offset"]
+        nbytes = dtype.itemsize * int(np.prod(desc["shape"]))
+        arrays[name] = buf[offset:offset+nbytes].view(dtype).reshape(desc["shape"])
+    return header, arrays